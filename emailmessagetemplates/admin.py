@@ -1,13 +1,19 @@
 from django.conf import settings
 from django.contrib import admin
 from django import forms
+from django.utils.html import format_html, format_html_join
 
-from models import EmailMessageTemplate
+from models import EmailMessageTemplate, EmailMessageTemplateStats, \
+    EmailTemplateFragment
 from forms import EmailListField
 
 
 class EmailMessageTemplateAdmin(admin.ModelAdmin):
-    readonly_fields = ('related_item_display',)
+    readonly_fields = ('related_item_display', 'version', 'render_statistics')
+    list_display = ('name', 'related_item_display', 'content_type', 'enabled',
+                    'edited_date')
+    list_filter = ('enabled', 'content_type')
+    search_fields = ('^name',)
     
     def __init__(self, *args, **kwargs):
         super(EmailMessageTemplateAdmin, self).__init__(*args, **kwargs)
@@ -15,6 +21,35 @@ class EmailMessageTemplateAdmin(admin.ModelAdmin):
         if not settings.EMAILMESSAGETEMPLATES_ALLOW_HTML_MESSAGES:
             self.exclude.extend(['type','autogenerate_text','body_template_html']) 
 
+    def get_queryset(self, request):
+        """
+        Fetch the related objects of all the templates on a page together, one 
+        query per content type, rather than one query per template.
+        """
+        queryset = super(EmailMessageTemplateAdmin, self).get_queryset(request)
+        return queryset.select_related('content_type')\
+            .prefetch_related('related_object')
+
+    def render_statistics(self, obj):
+        """
+        The render statistics recorded for the template, if any
+        """
+        try:
+            stats = obj.stats
+        except (EmailMessageTemplateStats.DoesNotExist, ValueError):
+            return "None recorded"
+        lines = [("{0} messages rendered ({1} slow parts), averaging {2} "
+                  "characters".format(stats.render_count, stats.slow_count,
+                                      stats.average_size),)]
+        for part in ('subject', 'html', 'text'):
+            p50, p95 = getattr(stats, part + '_p50'), getattr(stats, part + '_p95')
+            if p50 is not None:
+                lines.append(("{0}: {1:.2f}ms median, {2:.2f}ms 95th "
+                              "percentile".format(part.capitalize(), p50, p95),))
+        lines.append(("Updated {0}".format(stats.updated_date),))
+        return format_html_join(format_html('<br>'), '{0}', lines)
+    render_statistics.short_description = "Render statistics"
+
     def formfield_for_dbfield(self, db_field, **kwargs):
         if db_field.name in ['base_cc', 'base_bcc',]:
             request = kwargs.pop("request", None)
@@ -27,3 +62,10 @@ class EmailMessageTemplateAdmin(admin.ModelAdmin):
             )
     
 admin.site.register(EmailMessageTemplate, EmailMessageTemplateAdmin)
+
+
+class EmailTemplateFragmentAdmin(admin.ModelAdmin):
+    list_display = ('name', 'description', 'edited_date')
+    search_fields = ('name',)
+
+admin.site.register(EmailTemplateFragment, EmailTemplateFragmentAdmin)
@@ -0,0 +1,124 @@
+"""
+Attachments shared by many messages in a bulk send
+"""
+import base64
+import mimetypes
+import mmap
+import os
+import threading
+from email.mime.base import MIMEBase
+
+from django.core.mail.message import DEFAULT_ATTACHMENT_MIME_TYPE
+from django.utils import six
+
+# Files are encoded a chunk at a time; a multiple of the 57 bytes encoded on
+# each line, so the chunks' encodings can simply be joined
+ENCODE_CHUNK_SIZE = 57 * 1024
+
+
+class SharedAttachment(object):
+    """
+    A file attached to every message of a bulk send.  The file (given by path,
+    or as a string or buffer) is only read and base64-encoded once, the first
+    time a message using it is built, and every message then shares the same
+    encoded MIME part rather than holding its own copy of the content.
+
+    Files are memory-mapped while they're encoded, so they're never read into
+    memory in full.
+    """
+
+    def __init__(self, path=None, content=None, filename=None, mimetype=None):
+        if (path is None) == (content is None):
+            raise ValueError("Either a path or content must be given.")
+        if isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+        self.path = path
+        self.content = content
+        self.filename = filename or (os.path.basename(path) if path else None)
+        self.mimetype = mimetype or \
+            (self.filename and mimetypes.guess_type(self.filename)[0]) or \
+            DEFAULT_ATTACHMENT_MIME_TYPE
+        self._part = None
+        self._lock = threading.Lock()
+
+    def mime_part(self):
+        """
+        Returns the encoded MIME part, encoding the attachment the first time
+        it's called.
+        """
+        if self._part is None:
+            with self._lock:
+                if self._part is None:
+                    self._part = self._encode()
+                    # The encoded part is all that's needed from now on
+                    self.content = None
+        return self._part
+
+    def _encode(self):
+        part = MIMEBase(*self.mimetype.split('/', 1))
+        if self.path is None:
+            part.set_payload(_base64(self.content))
+        else:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        part.set_payload(_base64(data))
+                    finally:
+                        data.close()
+                else:
+                    # Empty files can't be mapped
+                    part.set_payload('')
+        part['Content-Transfer-Encoding'] = 'base64'
+        if self.filename:
+            filename = self.filename
+            try:
+                filename.encode('ascii')
+            except UnicodeEncodeError:
+                if six.PY2:
+                    filename = filename.encode('utf-8')
+                filename = ('utf-8', '', filename)
+            part.add_header('Content-Disposition', 'attachment',
+                            filename=filename)
+        return part
+
+    def __repr__(self):
+        return '<SharedAttachment: {0}>'.format(self.filename)
+
+
+def shared_attachments(attachments):
+    """
+    Converts a sequence of attachments given as file paths, (filename, content,
+    mimetype) tuples, SharedAttachments or MIME parts to a list of
+    SharedAttachments and MIME parts that can be shared by many messages.
+    """
+    shared = []
+    for attachment in attachments or ():
+        if isinstance(attachment, six.string_types):
+            attachment = SharedAttachment(attachment)
+        elif isinstance(attachment, tuple):
+            filename, content, mimetype = \
+                (tuple(attachment) + (None, None, None))[:3]
+            attachment = SharedAttachment(content=content, filename=filename,
+                                          mimetype=mimetype)
+        shared.append(attachment)
+    return shared
+
+
+def mime_part(attachment):
+    """
+    Returns the MIME part for a SharedAttachment, or any other attachment
+    unchanged.
+    """
+    if isinstance(attachment, SharedAttachment):
+        return attachment.mime_part()
+    return attachment
+
+
+def _base64(data):
+    """
+    Base64-encode a string or buffer in chunks, with line breaks as MIME
+    requires.
+    """
+    return ''.join(base64.encodestring(data[i:i + ENCODE_CHUNK_SIZE])
+                   for i in range(0, len(data), ENCODE_CHUNK_SIZE))
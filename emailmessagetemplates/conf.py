@@ -13,4 +13,85 @@ class MyAppConf(AppConf):
     """
     If true, templates can produce HTML-formatted messages and provide 
     plain-text alternative content.
-    """
\ No newline at end of file
+    """
+
+    ENGINE = None
+    """
+    The alias (from the TEMPLATES setting) of the template engine used to 
+    render and validate message templates.  If None, the first DjangoTemplates 
+    engine is used.
+    """
+
+    SEND_RATE = None
+    """
+    The maximum number of messages per second the bulk helpers (e.g. 
+    ``send_mass_mail``) will send.  If None, messages are sent as fast as the 
+    connection allows.
+    """
+
+    SEND_BURST = 1
+    """
+    The number of messages that may be sent back-to-back before the rate limit
+    applies.  Only used when SEND_RATE is set.
+    """
+
+    SEND_CONCURRENCY = 1
+    """
+    The maximum number of connections opened at once by the bulk helpers.
+    """
+
+    SEND_RETRIES = 3
+    """
+    The number of times a message is retried after a temporary (4xx) SMTP 
+    error before it is treated as failed.
+    """
+
+    SEND_BACKOFF = 1.0
+    """
+    The delay, in seconds, before the first retry of a message that hit a 
+    temporary error.  The delay doubles with each subsequent retry.
+    """
+
+    SEND_MAX_BACKOFF = 60.0
+    """
+    The longest delay, in seconds, between retries of a message.
+    """
+
+    SEND_CHUNK_SIZE = 100
+    """
+    The number of messages handed to a relay at a time when a bulk send is 
+    spread across several relays.
+    """
+
+    FRAGMENT_CACHE = 'default'
+    """
+    The alias (from the CACHES setting) of the cache used to tell every 
+    process that fragments have changed.  It must be shared by all processes 
+    (e.g. Memcached or Redis rather than the local memory cache) for them to 
+    pick up changes without restarting.
+    """
+
+    FRAGMENT_CHECK_INTERVAL = 1
+    """
+    The minimum number of seconds between checks of the shared cache for 
+    changes to fragments made by other processes.
+    """
+
+    STATS = False
+    """
+    If true, the time taken to render each part of a message and the size of 
+    the output are recorded for each template, and written to its 
+    EmailMessageTemplateStats periodically.
+    """
+
+    STATS_FLUSH_INTERVAL = 60
+    """
+    The minimum number of seconds between writes of a process's recorded 
+    render statistics to the database.
+    """
+
+    SLOW_RENDER_THRESHOLD = None
+    """
+    If set, a warning naming the template and the context's keys is logged 
+    whenever rendering a part of a message takes at least this many seconds.
+    """
@@ -0,0 +1,52 @@
+"""
+Context values that are only computed if a template uses them
+"""
+from functools import partial
+
+_unset = object()
+
+
+class Lazy(object):
+    """
+    Wraps a function computing a context value (such as a queryset or an
+    expensive calculation) so it's only called if a template actually renders
+    the variable, and then only once however many times it's used, e.g.:
+
+        send_mail(name, context={'orders': Lazy(user.orders.all)}, ...)
+
+    Django templates call the value when they first resolve it.  For other
+    engines, values are evaluated before rendering if the template references
+    them (see ``engine.referenced_variables``).
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._func = partial(func, *args, **kwargs) if args or kwargs else func
+        self._value = _unset
+
+    def __call__(self):
+        if self._value is _unset:
+            self._value = self._func()
+            self._func = None
+        return self._value
+
+    @property
+    def evaluated(self):
+        """
+        Whether the value has been computed yet
+        """
+        return self._value is not _unset
+
+    def __repr__(self):
+        if self.evaluated:
+            return '<Lazy: {0!r}>'.format(self._value)
+        return '<Lazy: unevaluated>'
+
+
+def resolve(context, names=None):
+    """
+    Returns a copy of a context dictionary with its Lazy values evaluated: only
+    those with the given names, or all of them if names is None.
+    """
+    return dict((key, value() if isinstance(value, Lazy) and
+                 (names is None or key in names) else value)
+                for key, value in context.items())
@@ -0,0 +1,589 @@
+"""
+Scheduling for bulk delivery of templated messages
+"""
+import errno
+import random
+import smtplib
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from django.core.mail import get_connection
+from django.db import connections
+
+from conf import settings
+
+# time.monotonic isn't available under Python 2
+_clock = getattr(time, 'monotonic', time.time)
+
+TEMPORARY_SOCKET_ERRORS = (errno.ECONNRESET, errno.ECONNREFUSED, errno.EPIPE,
+                           errno.ETIMEDOUT)
+
+
+def is_temporary_error(error):
+    """
+    Returns True if an exception raised while sending a message represents a
+    temporary condition that is worth retrying after a delay (e.g. a 421 or
+    451 reply from a throttling relay, or a dropped connection).
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for (code, msg) in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, (smtplib.SMTPServerDisconnected, socket.timeout)):
+        return True
+    if isinstance(error, socket.error):
+        return getattr(error, 'errno', None) in TEMPORARY_SOCKET_ERRORS
+    return False
+
+
+def is_disconnect_error(error):
+    """
+    Returns True if an exception indicates the connection can't be reused.
+    """
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    return isinstance(error, (smtplib.SMTPServerDisconnected, socket.error))
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket limiting how quickly messages are sent.  Tokens
+    accumulate at ``rate`` per second up to ``capacity``, and each message
+    consumes one.
+
+    The current rate adapts to the relay: ``slow_down`` halves it (e.g. when
+    the relay replies that we're sending too fast) and ``speed_up`` gradually
+    restores it to the configured maximum as messages succeed.
+    """
+
+    def __init__(self, rate, capacity=1, min_rate=None, clock=_clock,
+                 sleep=time.sleep):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.min_rate = float(min_rate) if min_rate else self.max_rate / 64
+        self.capacity = float(max(capacity or 1, 1))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = max(now - self._updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self._updated = now
+
+    def consume(self):
+        """
+        Take a token from the bucket, blocking until one is available.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                # Allow for floating point error in the refill arithmetic
+                if self.tokens >= 1 - 1e-9:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def slow_down(self):
+        """
+        Halve the current rate and drain any accumulated tokens.
+        """
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def speed_up(self):
+        """
+        Nudge the current rate back toward the configured maximum.
+        """
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate,
+                                self.rate + self.max_rate / 20)
+
+
+class Relay(object):
+    """
+    A destination bulk sends can be spread across: a callable returning a 
+    connection to the relay, and the relay's capacity.  ``weight`` sets the 
+    relay's share of the messages relative to the other relays, and 
+    ``concurrency`` and ``rate`` (if set) override the scheduler's connection
+    cap and rate limit for this relay.
+    """
+
+    def __init__(self, connection_factory, weight=1, concurrency=None,
+                 rate=None, name=None):
+        self.connection_factory = connection_factory
+        self.weight = weight
+        self.concurrency = concurrency
+        self.rate = rate
+        self.name = name
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a relay from an existing connection, or from a dictionary of
+        keyword arguments for ``get_connection`` (e.g. ``backend``, ``host`` 
+        and ``port``) which may also include ``weight``, ``concurrency`` and 
+        ``rate``.
+        """
+        if isinstance(config, Relay):
+            return config
+        if isinstance(config, dict):
+            options = dict(config)
+            weight = options.pop('weight', 1)
+            concurrency = options.pop('concurrency', None)
+            rate = options.pop('rate', None)
+            name = options.get('host') or options.get('backend')
+            return cls(lambda: get_connection(**options), weight=weight,
+                       concurrency=concurrency, rate=rate, name=name)
+        # A connection instance can't be shared between threads
+        return cls(lambda: config, concurrency=1)
+
+    def __repr__(self):
+        return '<Relay {0}>'.format(self.name or id(self))
+
+
+class DeliveryScheduler(object):
+    """
+    Sends a stream of messages while respecting the limits of the relay: an
+    optional messages-per-second rate limit, a cap on the number of
+    connections used at once, and exponential backoff (with a reduced send
+    rate) when the relay reports a temporary error.
+
+    Messages can be spread across several relays, in which case they're sent 
+    to all of them at once in chunks shared out according to each relay's 
+    weight.  If a relay can't be reached its messages are failed over to the 
+    others.
+
+    Defaults are taken from the EMAILMESSAGETEMPLATES_SEND_* settings.
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None, retries=None,
+                 backoff=None, max_backoff=None, chunk_size=None,
+                 sleep=time.sleep):
+        setting = lambda value, name: value if value is not None else \
+            getattr(settings, 'EMAILMESSAGETEMPLATES_SEND_' + name)
+
+        self.rate = setting(rate, 'RATE')
+        self.burst = setting(burst, 'BURST')
+        self.concurrency = max(int(setting(concurrency, 'CONCURRENCY')), 1)
+        self.retries = setting(retries, 'RETRIES')
+        self.backoff = setting(backoff, 'BACKOFF')
+        self.max_backoff = setting(max_backoff, 'MAX_BACKOFF')
+        self.chunk_size = max(int(setting(chunk_size, 'CHUNK_SIZE')), 1)
+        self.sleep = sleep
+
+    def deliver(self, messages, connection_factory=None, concurrency=None,
+                relays=None):
+        """
+        Send each of the messages, returning a BulkResult describing the 
+        outcome for each one.  A message that fails doesn't prevent the others 
+        from being sent.
+
+        Each message may instead be a callable returning the message, in which 
+        case it's called (in the worker that sends it) just before sending, so 
+        messages are rendered as they're sent rather than all up front, and a 
+        message that can't be rendered is reported as failed.
+
+        ``connection_factory`` is called (without arguments) once per worker to
+        get the connection that worker sends through, so it should return a
+        new connection if more than one worker is used.  ``concurrency``
+        overrides the scheduler's connection cap for this delivery.  
+        Alternatively, a list of Relays (or anything accepted by 
+        ``Relay.from_config``) can be given to spread the messages across.
+        """
+        if relays is None:
+            relays = [Relay(connection_factory, concurrency=concurrency)]
+        relays = [Relay.from_config(relay) for relay in relays]
+        dispatcher = _Dispatcher(messages, relays, self.chunk_size)
+
+        workers = []
+        for relay in relays:
+            rate = relay.rate or self.rate
+            bucket = TokenBucket(rate, self.burst, sleep=self.sleep) \
+                if rate else None
+            for i in range(relay.concurrency or self.concurrency):
+                dispatcher.add_worker(relay)
+                workers.append((relay, bucket))
+
+        if len(workers) == 1:
+            self._work(dispatcher, *workers[0])
+        else:
+            threads = [threading.Thread(target=self._work_in_thread,
+                                        args=(dispatcher,) + worker)
+                       for worker in workers]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return dispatcher.result()
+
+    def _work(self, dispatcher, relay, bucket):
+        """
+        Take chunks of messages for a relay from the dispatcher and send them 
+        through a single connection until there are none left, or this worker 
+        can't connect to the relay.
+        """
+        connection = None
+        opened = False
+        try:
+            while True:
+                chunk = dispatcher.next_chunk(relay)
+                if chunk is None:
+                    break
+                for position, (index, message) in enumerate(chunk):
+                    if connection is None:
+                        try:
+                            connection, opened = self._connect(relay)
+                        except Exception:
+                            # Other workers may still be connected to the 
+                            # relay (e.g. if it limits connections per host),
+                            # so only this worker gives up
+                            dispatcher.retire(relay, chunk[position:],
+                                              sys.exc_info())
+                            return
+
+                    result = MessageResult(index)
+                    start = _clock()
+                    try:
+                        if callable(message):
+                            message = message()
+                        self._send(message, connection, bucket, result)
+                    except Exception as e:
+                        result.status = MessageResult.FAILED
+                        result.error = e
+                        result.exc_info = sys.exc_info()
+                        if is_disconnect_error(e):
+                            # Reconnect before the next message, which will 
+                            # fail the relay over if it's become unreachable
+                            _close_connection(connection, opened)
+                            connection = None
+                            opened = False
+                    result.duration = _clock() - start
+                    dispatcher.add(result)
+        finally:
+            dispatcher.leave()
+            if connection is not None:
+                _close_connection(connection, opened)
+
+    def _work_in_thread(self, dispatcher, relay, bucket):
+        try:
+            self._work(dispatcher, relay, bucket)
+        finally:
+            # Rendering may have opened database connections in this thread 
+            # (e.g. to load fragments), which Django won't close
+            connections.close_all()
+
+    def _connect(self, relay):
+        """
+        Open a connection to a relay, retrying temporary failures with backoff.
+        Returns the connection and whether it was opened here (and so should be
+        closed when we're finished with it).
+        """
+        attempts = 0
+        while True:
+            try:
+                connection = relay.connection_factory()
+                return connection, connection.open()
+            except Exception as e:
+                attempts += 1
+                if attempts > self.retries or not is_temporary_error(e):
+                    raise
+                self._backoff(attempts)
+
+    def _send(self, message, connection, bucket, result):
+        """
+        Send one message, retrying temporary failures with backoff.
+        """
+        while True:
+            if bucket is not None:
+                bucket.consume()
+            result.attempts += 1
+            try:
+                sent = connection.send_messages([message])
+            except Exception as e:
+                if result.attempts > self.retries or not is_temporary_error(e):
+                    raise
+                if bucket is not None:
+                    bucket.slow_down()
+                if is_disconnect_error(e):
+                    _reset_connection(connection)
+                self._backoff(result.attempts)
+            else:
+                if bucket is not None:
+                    bucket.speed_up()
+                if sent:
+                    result.status = MessageResult.SENT
+                return
+
+    def _backoff(self, attempts):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        self.sleep(delay * random.uniform(0.5, 1.0))
+
+
+class MessageResult(object):
+    """
+    The outcome of sending one message (a row of the ``datatuple`` passed to 
+    ``send_mass_mail``).  ``duration`` is the time in seconds spent rendering 
+    and sending the message, including any retries.  ``exc_info`` is the 
+    ``sys.exc_info()`` of the error, so it can be re-raised with its original 
+    traceback.
+    """
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    def __init__(self, index, status=FAILED, error=None, attempts=0,
+                 duration=0.0, exc_info=None):
+        self.index = index
+        self.status = status
+        self.error = error
+        self.exc_info = exc_info
+        self.attempts = attempts
+        self.duration = duration
+
+    @property
+    def error_class(self):
+        """
+        The name of the class of the exception that caused the message to 
+        fail, if any.
+        """
+        return type(self.error).__name__ if self.error is not None else None
+
+    def __repr__(self):
+        return '<MessageResult {0}: {1}{2}>'.format(
+            self.index, self.status,
+            ' ({0})'.format(self.error_class) if self.error_class else '')
+
+
+class BulkResult(object):
+    """
+    The outcome of a bulk send, with a MessageResult for each message in the 
+    order the messages were given.  Messages that were rejected or raised an 
+    error are reported as failed, so that only those rows need to be retried.
+    """
+
+    def __init__(self, rows, duration=0.0):
+        self.rows = rows
+        self.duration = duration
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __int__(self):
+        return self.sent
+
+    @property
+    def sent(self):
+        """The number of messages sent successfully"""
+        return sum(1 for row in self.rows if row.status == MessageResult.SENT)
+
+    @property
+    def failures(self):
+        """The results for the messages that couldn't be sent"""
+        return [row for row in self.rows if row.status != MessageResult.SENT]
+
+    @property
+    def failed(self):
+        """The number of messages that couldn't be sent"""
+        return len(self.failures)
+
+    def error_counts(self):
+        """
+        Returns a dictionary of the number of failed messages by error class.
+        """
+        counts = {}
+        for row in self.failures:
+            counts[row.error_class] = counts.get(row.error_class, 0) + 1
+        return counts
+
+    def failed_rows(self, datatuple):
+        """
+        Returns the rows of the ``datatuple`` that was sent whose messages 
+        failed, ready to be passed to ``send_mass_mail`` to retry them.
+        """
+        datatuple = list(datatuple)
+        return [datatuple[row.index] for row in self.failures]
+
+    def __repr__(self):
+        return '<BulkResult: {0} sent, {1} failed>'.format(self.sent,
+                                                           self.failed)
+
+
+class _Dispatcher(object):
+    """
+    Shares the messages of a single delivery out among the workers of each 
+    relay, and collects the results.
+
+    Messages are read from the source in chunks as workers need them, and each 
+    chunk is assigned to a relay by smooth weighted round-robin so relays 
+    receive chunks in proportion to their weights.  Once the source is 
+    exhausted idle workers take chunks still waiting for other relays, so a 
+    slow relay doesn't hold up the end of the send.  Chunks returned by a 
+    worker that couldn't connect, or belonging to a relay none of whose 
+    workers could connect, are given to the first worker that asks.
+    """
+
+    def __init__(self, messages, relays, chunk_size):
+        self.messages = enumerate(messages)
+        self.relays = relays
+        self.chunk_size = chunk_size
+        self.queues = dict((relay, deque()) for relay in relays)
+        self.credit = dict((relay, 0) for relay in relays)
+        self.orphans = deque()
+        self.down = {}
+        # The number of workers of each relay that haven't given up, and the
+        # chunk each worker is sending
+        self.workers = dict((relay, 0) for relay in relays)
+        self.in_flight = {}
+        self.results = []
+        self.started = _clock()
+        self._lock = threading.Condition()
+
+    def add_worker(self, relay):
+        with self._lock:
+            self.workers[relay] += 1
+
+    def next_chunk(self, relay):
+        """
+        Returns the next chunk for the calling worker to send, or None once 
+        every message has been handed out.  A worker asking for a chunk has 
+        finished its previous one.  While other workers are still sending 
+        chunks they might return, this waits rather than returning None, so 
+        returned messages are always picked up.
+        """
+        worker = threading.current_thread()
+        with self._lock:
+            self._finish(worker)
+            while relay not in self.down:
+                chunk = self._take(relay)
+                if chunk is not None:
+                    self.in_flight[worker] = chunk
+                    return chunk
+                if not self.in_flight:
+                    break
+                self._lock.wait()
+            return None
+
+    def _take(self, relay):
+        if self.orphans:
+            return self.orphans.popleft()
+        queue = self.queues[relay]
+        while not queue:
+            chunk = list(islice(self.messages, self.chunk_size))
+            if not chunk:
+                break
+            self._assign(chunk)
+        if queue:
+            return queue.popleft()
+        for other in self.queues.values():
+            if other:
+                return other.pop()
+        return None
+
+    def _finish(self, worker):
+        if self.in_flight.pop(worker, None) is not None:
+            self._lock.notify_all()
+
+    def leave(self):
+        """
+        Called by each worker as it stops, so other workers don't wait for a 
+        chunk it won't return.
+        """
+        with self._lock:
+            self._finish(threading.current_thread())
+
+    def _assign(self, chunk):
+        healthy = [relay for relay in self.relays if relay not in self.down]
+        total = sum(relay.weight for relay in healthy)
+        for relay in healthy:
+            self.credit[relay] += relay.weight
+        chosen = max(healthy, key=lambda relay: self.credit[relay])
+        self.credit[chosen] -= total
+        self.queues[chosen].append(chunk)
+
+    def retire(self, relay, remaining, exc_info):
+        """
+        Stop a worker that couldn't connect to its relay, returning the 
+        messages it hadn't sent for other workers to send.  Once none of a 
+        relay's workers can connect the relay is marked as unreachable and its 
+        chunks passed to the other relays; if none are left, every unsent 
+        message fails with the error (given as a ``sys.exc_info()`` tuple).
+        """
+        error = exc_info[1]
+        with self._lock:
+            self._finish(threading.current_thread())
+            if remaining:
+                self.orphans.appendleft(remaining)
+            self.workers[relay] -= 1
+            if self.workers[relay] <= 0:
+                self.down[relay] = error
+                self.orphans.extend(self.queues[relay])
+                self.queues[relay].clear()
+                if len(self.down) == len(self.relays):
+                    self._fail_remaining(exc_info)
+            self._lock.notify_all()
+
+    def _fail_remaining(self, exc_info):
+        for chunk in self.orphans:
+            self._fail_chunk(chunk, exc_info)
+        self.orphans.clear()
+        self._fail_chunk(self.messages, exc_info)
+
+    def _fail_chunk(self, chunk, exc_info):
+        for (index, message) in chunk:
+            self.results.append(MessageResult(index, error=exc_info[1],
+                                              exc_info=exc_info))
+
+    def add(self, result):
+        with self._lock:
+            self.results.append(result)
+
+    def result(self):
+        rows = sorted(self.results, key=lambda row: row.index)
+        return BulkResult(rows, duration=_clock() - self.started)
+
+
+def _close_connection(connection, opened):
+    """
+    Close a connection if we opened it, ignoring errors from a relay that has
+    already gone away.
+    """
+    if not opened:
+        return
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def _reset_connection(connection):
+    """
+    Discard a connection the relay has dropped and open a fresh one.
+    """
+    try:
+        connection.close()
+    except Exception:
+        connection.connection = None
+    try:
+        connection.open()
+    except Exception:
+        # Leave it to the next attempt to open the connection (and report the
+        # error if the relay is still unavailable)
+        pass
@@ -0,0 +1,307 @@
+"""
+Compiling and rendering stored templates with the configured template engine
+"""
+import sys
+import uuid
+from timeit import default_timer as _clock
+
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Context, TemplateDoesNotExist, \
+    TemplateSyntaxError, engines
+from django.template.backends.django import DjangoTemplates
+from django.template.base import FilterExpression, Node, NodeList, Variable
+from django.template.defaulttags import ForNode, WithNode
+from django.template.loader_tags import ExtendsNode, IncludeNode
+from django.template.smartif import TokenBase
+from django.utils import six
+
+from conf import settings
+from context import Lazy, resolve
+
+# Compiled templates are cached by engine and source, so each distinct template
+# is only parsed once per process.  The cache is cleared when it fills up.
+CACHE_SIZE = 1000
+_compiled = {}
+_variables = {}
+
+# Names the Django template language defines itself
+BUILTIN_VARIABLES = frozenset(['forloop', 'block'])
+
+# Changes to fragments are announced to every process by storing a new token
+# under this key in the shared cache.  Each process remembers the token its
+# cached templates were loaded under, and when it last compared it.
+FRAGMENTS_KEY = 'emailmessagetemplates:fragments'
+_fragments = {'token': None, 'checked': None}
+
+
+def get_engine():
+    """
+    Returns the template backend used to render message templates: the one
+    named by the EMAILMESSAGETEMPLATES_ENGINE setting, or the first
+    DjangoTemplates backend in the TEMPLATES setting.
+    """
+    alias = settings.EMAILMESSAGETEMPLATES_ENGINE
+    if alias:
+        return engines[alias]
+    for engine in engines.all():
+        if isinstance(engine, DjangoTemplates):
+            return engine
+    raise ImproperlyConfigured("No DjangoTemplates backend is configured.")
+
+
+def compile_template(source, engine=None):
+    """
+    Compile a template string with the given (or configured) engine, raising
+    TemplateSyntaxError if it isn't valid whichever engine is used.
+    """
+    engine = engine or get_engine()
+    try:
+        return engine.from_string(source)
+    except TemplateSyntaxError:
+        raise
+    except Exception as e:
+        # Unlike get_template, backends' from_string methods don't translate
+        # their engine's syntax errors (e.g. Jinja2's) to Django's
+        if type(e).__name__ != 'TemplateSyntaxError':
+            raise
+        six.reraise(TemplateSyntaxError, TemplateSyntaxError(str(e)),
+                    sys.exc_info()[2])
+
+
+def get_template(source):
+    """
+    Returns the compiled template for a template string, compiling it with the
+    configured engine if it hasn't been already.
+    """
+    check_fragments()
+    engine = get_engine()
+    key = (engine, source)
+    try:
+        return _compiled[key]
+    except KeyError:
+        if len(_compiled) >= CACHE_SIZE:
+            _compiled.clear()
+        template = _compiled[key] = compile_template(source, engine)
+        return template
+
+
+def render_template(source, context):
+    """
+    Render a template string against a dictionary or Context.  A Context is 
+    rendered as it is by Django templates, keeping its settings (such as 
+    autoescape).  Lazy values are left for Django templates to call as they're 
+    used; for other engines, those the template references are evaluated 
+    first.
+    """
+    template = get_template(source)
+    if isinstance(get_engine(), DjangoTemplates):
+        if isinstance(context, Context):
+            return template.template.render(context)
+        return template.render(context)
+    if isinstance(context, Context):
+        context = context.flatten()
+    if any(isinstance(value, Lazy) for value in context.values()):
+        context = resolve(context, referenced_variables(source))
+    return template.render(context)
+
+
+def referenced_variables(source):
+    """
+    Returns the set of context variable names a template string uses, found by 
+    analysing the compiled template (and any templates it includes or extends 
+    by name), or None if they can't be determined.  Names bound by the 
+    template itself, such as ``for`` loop variables, aren't included unless 
+    they're also used outside the block that binds them.
+    """
+    engine = get_engine()
+    key = (engine, source)
+    try:
+        return _variables[key]
+    except KeyError:
+        if len(_variables) >= CACHE_SIZE:
+            _variables.clear()
+        if isinstance(engine, DjangoTemplates):
+            names = _django_variables(get_template(source).template)
+        else:
+            names = _jinja2_variables(engine, source)
+        _variables[key] = names
+        return names
+
+
+def _django_variables(template, seen=()):
+    """
+    Collect the variables used by a compiled Django template.
+    """
+    names = set()
+    if not _scope_variables(template, template.nodelist, BUILTIN_VARIABLES,
+                            names, seen):
+        return None
+    return frozenset(names)
+
+
+def _scope_variables(template, nodelist, bound, names, seen):
+    """
+    Add the variables used by a list of nodes to a set, other than those in 
+    ``bound`` (the names bound by the tags enclosing them).  Returns False if 
+    the variables can't be determined.
+    """
+    for node in nodelist:
+        found = set()
+        _collect_variables(vars(node), found)
+        inner = bound
+        if isinstance(node, ForNode):
+            inner = bound | frozenset(node.loopvars)
+        elif isinstance(node, (WithNode, IncludeNode)):
+            inner = bound | frozenset(node.extra_context)
+        if isinstance(node, (ExtendsNode, IncludeNode)):
+            name = node.parent_name if isinstance(node, ExtendsNode) \
+                else node.template
+            if not isinstance(name.var, six.string_types) or name.filters:
+                # The template to load depends on the context
+                return False
+            if name.var not in seen:
+                try:
+                    loaded = template.engine.get_template(name.var)
+                except TemplateDoesNotExist:
+                    return False
+                loaded_names = _django_variables(loaded, seen + (name.var,))
+                if loaded_names is None:
+                    return False
+                # An included template sees the names bound around the tag
+                names.update(loaded_names - inner)
+        names.update(found - bound)
+        for attr in node.child_nodelists:
+            child = getattr(node, attr, None)
+            # The {% empty %} clause of a loop doesn't see its variables
+            scope = bound if attr == 'nodelist_empty' else inner
+            if child and not _scope_variables(template, child, scope, names,
+                                              seen):
+                return False
+    return True
+
+
+def _collect_variables(value, names, depth=0):
+    """
+    Add the names of the variables in a node's attributes to a set.  Child 
+    nodes are skipped, since they're visited separately.
+    """
+    if isinstance(value, FilterExpression):
+        _collect_variables(value.var, names, depth)
+        for func, args in value.filters:
+            for lookup, arg in args:
+                _collect_variables(arg, names, depth)
+    elif isinstance(value, Variable):
+        if value.lookups:
+            names.add(value.lookups[0])
+    elif depth > 10 or isinstance(value, (Node, NodeList, six.string_types)):
+        return
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect_variables(item, names, depth + 1)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _collect_variables(item, names, depth + 1)
+    elif isinstance(value, TokenBase):
+        # A condition of an {% if %} tag
+        _collect_variables(vars(value), names, depth + 1)
+
+
+def _jinja2_variables(engine, source):
+    """
+    Collect the variables used by a template for a Jinja2 backend.
+    """
+    env = getattr(engine, 'env', None)
+    if env is None:
+        return None
+    from jinja2 import meta
+    ast = env.parse(source)
+    if any(True for name in meta.find_referenced_templates(ast)):
+        return None
+    return frozenset(meta.find_undeclared_variables(ast))
+
+
+def clear_cache():
+    """
+    Discard all compiled templates.
+    """
+    _compiled.clear()
+    _variables.clear()
+
+
+def fragments_changed():
+    """
+    Announce that fragments have changed, discarding this process's cached 
+    templates now and every other process's when it next checks.
+    """
+    token = uuid.uuid4().hex
+    _fragment_cache().set(FRAGMENTS_KEY, token, None)
+    _fragments['token'] = token
+    reset_fragments()
+
+
+def check_fragments():
+    """
+    Discard cached fragments if another process has changed fragments since 
+    they were loaded.  The shared cache is consulted at most once every 
+    EMAILMESSAGETEMPLATES_FRAGMENT_CHECK_INTERVAL seconds, and only if a 
+    template engine loads fragments.
+    """
+    now = _clock()
+    checked = _fragments['checked']
+    if checked is not None and \
+            now - checked < settings.EMAILMESSAGETEMPLATES_FRAGMENT_CHECK_INTERVAL:
+        return
+    _fragments['checked'] = now
+    if not _fragment_loaders():
+        return
+    token = _fragment_cache().get(FRAGMENTS_KEY)
+    if token != _fragments['token']:
+        _fragments['token'] = token
+        if checked is not None:
+            reset_fragments()
+
+
+def _fragment_cache():
+    return caches[settings.EMAILMESSAGETEMPLATES_FRAGMENT_CACHE]
+
+
+def _fragment_loaders():
+    """
+    Returns the loaders of the configured Django template engines that load 
+    fragments, either directly or by wrapping our loader (as a cached loader 
+    does).
+    """
+    from loaders import Loader
+
+    found = []
+    for engine in engines.all():
+        if isinstance(engine, DjangoTemplates):
+            for loader in engine.engine.template_loaders:
+                if isinstance(loader, Loader) or any(
+                        isinstance(wrapped, Loader)
+                        for wrapped in getattr(loader, 'loaders', ())):
+                    found.append(loader)
+    return found
+
+
+def reset_fragments():
+    """
+    Discard the fragments cached by the caching loaders of the configured 
+    Django template engines, along with our compiled templates.  Other 
+    templates those loaders have cached are kept, apart from the names they 
+    didn't find, which a new fragment may now provide.
+    """
+    from loaders import Loader
+
+    for loader in _fragment_loaders():
+        cache = getattr(loader, 'get_template_cache', None)
+        if cache is None:
+            if hasattr(loader, 'reset'):
+                loader.reset()
+            continue
+        for key, template in list(cache.items()):
+            origin = getattr(template, 'origin', None)
+            if origin is None or isinstance(origin.loader, Loader):
+                del cache[key]
+    clear_cache()
@@ -1,7 +1,9 @@
 from django.conf import settings
 from django.db import models
 from django.core.exceptions import ValidationError
-from django.template import Context, Template, TemplateSyntaxError
+from django.template import TemplateSyntaxError
+
+from engine import compile_template
 
 
 class SeparatedValuesField(models.TextField):
@@ -42,9 +44,23 @@ class SeparatedValuesField(models.TextField):
 
 def validate_template_syntax(value):
     """
-    Ensure that there aren't any gross errors in a template string
+    Ensure that there aren't any gross errors in a template string, using the 
+    same template engine messages are rendered with
+    """
+    try:
+        compile_template(value).render({})
+    except TemplateSyntaxError, e:
+        raise ValidationError("Invalid Template Syntax: " + e.message)
+
+
+def check_template_syntax(value):
+    """
+    A cheaper version of validate_template_syntax that only parses the 
+    template rather than also rendering it, for validating templates in bulk.  
+    Errors only raised when rendering (e.g. in included templates) aren't 
+    caught.
     """
     try:
-        Template(value).render(Context({}))
+        compile_template(value)
     except TemplateSyntaxError, e:
         raise ValidationError("Invalid Template Syntax: " + e.message)
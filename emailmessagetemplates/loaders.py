@@ -0,0 +1,30 @@
+"""
+A Django template loader serving EmailTemplateFragments
+"""
+from django.template import Origin, TemplateDoesNotExist
+from django.template.loaders.base import Loader as BaseLoader
+
+from models import EmailTemplateFragment
+
+
+class Loader(BaseLoader):
+    """
+    Loads templates from the EmailTemplateFragment with a matching name, so 
+    email templates can include or extend shared content stored in the 
+    database.
+
+    The loader does no caching of its own, and should be wrapped in Django's 
+    cached loader so each fragment is only fetched and parsed once per process.
+    Cached fragments are discarded when a fragment is saved or deleted.
+    """
+
+    def get_template_sources(self, template_name):
+        yield Origin(name=template_name, template_name=template_name,
+                     loader=self)
+
+    def get_contents(self, origin):
+        try:
+            return EmailTemplateFragment.objects.values_list(
+                'content', flat=True).get(name=origin.template_name)
+        except EmailTemplateFragment.DoesNotExist:
+            raise TemplateDoesNotExist(origin)
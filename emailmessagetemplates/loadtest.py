@@ -0,0 +1,277 @@
+"""
+A local SMTP sink and a driver for load testing the send helpers end to end
+"""
+import random
+import threading
+import time
+from collections import defaultdict
+from timeit import default_timer as _clock
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from django.core.mail import get_connection
+
+from delivery import DeliveryScheduler
+from utils import send_mail, send_mass_mail
+
+
+class SMTPSink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    A minimal SMTP server on localhost that accepts and discards messages,
+    for measuring the throughput of the send helpers without a real relay.
+    Each connection is handled in its own thread.
+
+    Relay behavior can be simulated:
+
+    - ``latency``: seconds to wait before accepting each message
+    - ``max_rate``: the number of messages accepted per second (across all
+      connections); further messages are refused with a 421 reply and the
+      connection closed, as a throttling relay would
+    - ``max_connections``: the number of simultaneous connections allowed;
+      further connections are refused with a 421 greeting
+    - ``failure_rate``: the proportion of messages refused with
+      ``failure_code`` (e.g. 451 for a temporary failure, or 554 for a
+      permanent one)
+
+    The counts of connections and replies are kept in ``stats``.  Use it as a
+    context manager, or call ``start`` and ``stop``.  With the default port of
+    0 a free port is chosen, available from ``port`` once it's created.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, max_rate=None,
+                 max_connections=None, failure_rate=0.0, failure_code=451,
+                 seed=None):
+        socketserver.TCPServer.__init__(self, (host, port), _SMTPHandler)
+        self.host, self.port = self.server_address[:2]
+        self.latency = latency
+        self.max_rate = max_rate
+        self.max_connections = max_connections
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the counts of connections and messages.
+        """
+        with self.lock:
+            self.stats = defaultdict(int)
+            self.active = 0
+            self._window = (0, 0)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def connection_settings(self):
+        """
+        Keyword arguments for ``get_connection`` to send through the sink.
+        """
+        return {'backend': 'django.core.mail.backends.smtp.EmailBackend',
+                'host': self.host, 'port': self.port, 'use_tls': False,
+                'use_ssl': False, 'username': '', 'password': ''}
+
+    def connect(self):
+        """
+        Returns whether a new connection is accepted, counting it.
+        """
+        with self.lock:
+            if self.max_connections and self.active >= self.max_connections:
+                self.stats['refused_connections'] += 1
+                return False
+            self.active += 1
+            self.stats['connections'] += 1
+            self.stats['peak_connections'] = max(
+                self.stats['peak_connections'], self.active)
+            return True
+
+    def disconnect(self):
+        with self.lock:
+            self.active -= 1
+
+    def accept(self, size):
+        """
+        Decide whether to accept a message of the given size, returning the
+        SMTP reply code.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if self.max_rate:
+                second, count = self._window
+                now = int(_clock())
+                if now != second:
+                    second, count = now, 0
+                if count >= self.max_rate:
+                    self.stats['throttled'] += 1
+                    return 421
+                self._window = (second, count + 1)
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                self.stats['failed'] += 1
+                return self.failure_code
+            self.stats['messages'] += 1
+            self.stats['bytes'] += size
+            return 250
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib and Django's SMTP backend.
+    """
+    replies = {
+        250: '250 OK',
+        421: '421 Too many messages, slow down',
+        451: '451 Temporary failure, try again later',
+        554: '554 Message rejected',
+    }
+
+    def handle(self):
+        server = self.server
+        if not server.connect():
+            self.reply('421 Too many connections')
+            return
+        try:
+            self.reply('220 localhost SMTP sink')
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                command = line.strip().split(b' ', 1)[0].upper()
+                if command in (b'EHLO', b'HELO'):
+                    self.reply('250 localhost')
+                elif command in (b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                    self.reply('250 OK')
+                elif command == b'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    code = server.accept(self.read_data())
+                    self.reply(self.replies.get(code, '%d Failed' % code))
+                    if code == 421:
+                        return
+                elif command == b'QUIT':
+                    self.reply('221 Bye')
+                    return
+                else:
+                    self.reply('502 Command not implemented')
+        finally:
+            server.disconnect()
+
+    def read_data(self):
+        size = 0
+        for line in iter(self.rfile.readline, b''):
+            if line in (b'.\r\n', b'.\n'):
+                break
+            size += len(line)
+        return size
+
+    def reply(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+
+class LoadTestResult(object):
+    """
+    The outcome of sending a batch of messages through an SMTPSink
+    """
+
+    def __init__(self, helper, concurrency, result, duration, stats):
+        self.helper = helper
+        self.concurrency = concurrency
+        self.sent = result.sent
+        self.failed = result.failed
+        self.errors = result.error_counts()
+        self.duration = duration
+        self.stats = dict(stats)
+
+    @property
+    def rate(self):
+        """The number of messages sent per second"""
+        return self.sent / self.duration if self.duration else 0.0
+
+    def __repr__(self):
+        return '<LoadTestResult {0} x{1}: {2:.1f} messages/s>'.format(
+            self.helper, self.concurrency, self.rate)
+
+
+def run_load_test(sink, name, related_object=None, context=None, count=100,
+                  concurrency=(1, 2, 4, 8), send_mail_count=None,
+                  scheduler_options=None):
+    """
+    Send messages from a template through an SMTPSink: ``send_mail_count``
+    (by default, ``count``) messages one at a time with ``send_mail``, then
+    ``count`` messages with ``send_mass_mail`` at each level of concurrency.
+    Returns a LoadTestResult for each run.
+
+    Any ``scheduler_options`` (e.g. ``retries`` and ``backoff``) are passed to
+    the DeliveryScheduler used by ``send_mass_mail``.
+    """
+    context = context or {}
+    recipients = ['recipient@example.com']
+    results = []
+
+    sink.reset()
+    outcome = _SendMailResult()
+    start = _clock()
+    for i in range(count if send_mail_count is None else send_mail_count):
+        try:
+            outcome.add(send_mail(
+                name, related_object, context, recipient_list=recipients,
+                connection=get_connection(**sink.connection_settings())))
+        except Exception as e:
+            outcome.add(0, e)
+    results.append(LoadTestResult('send_mail', 1, outcome, _clock() - start,
+                                  sink.stats))
+
+    datatuple = [(context, None, recipients)] * count
+    for level in concurrency:
+        sink.reset()
+        scheduler = DeliveryScheduler(concurrency=level,
+                                      **(scheduler_options or {}))
+        start = _clock()
+        result = send_mass_mail(
+            name, related_object, datatuple, scheduler=scheduler,
+            return_result=True, connections=[sink.connection_settings()])
+        results.append(LoadTestResult('send_mass_mail', level, result,
+                                      _clock() - start, sink.stats))
+    return results
+
+
+class _SendMailResult(object):
+    """
+    Tallies the outcome of separate send_mail calls like a BulkResult
+    """
+
+    def __init__(self):
+        self.sent = self.failed = 0
+        self.errors = defaultdict(int)
+
+    def add(self, sent, error=None):
+        if sent:
+            self.sent += 1
+        else:
+            self.failed += 1
+            self.errors[type(error).__name__ if error else None] += 1
+
+    def error_counts(self):
+        return dict(self.errors)
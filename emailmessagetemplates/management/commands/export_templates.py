@@ -0,0 +1,44 @@
+"""
+Write every email template to a JSON or YAML file
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emailmessagetemplates.models import EmailMessageTemplate
+
+
+class Command(BaseCommand):
+    help = ("Write every email template to a JSON or YAML file that can be "
+            "loaded with import_templates.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help="The file to write (by "
+                            "default, the templates are written to stdout).")
+        parser.add_argument('--format', choices=('json', 'yaml'),
+                            help="The format to write (by default, guessed "
+                            "from the file's extension, or JSON).")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('yaml' if path and path.lower().endswith(
+            ('.yaml', '.yml')) else 'json')
+        rows = EmailMessageTemplate.objects.export_templates()
+
+        if format == 'yaml':
+            try:
+                import yaml
+            except ImportError:
+                raise CommandError("PyYAML is required to export YAML.")
+            output = yaml.safe_dump(rows, default_flow_style=False,
+                                    allow_unicode=True, encoding=None)
+        else:
+            output = json.dumps(rows, indent=2, sort_keys=True,
+                                ensure_ascii=False) + '\n'
+
+        if path:
+            with open(path, 'wb') as f:
+                f.write(output.encode('utf-8'))
+            self.stderr.write("Exported %d templates to %s" % (len(rows), path))
+        else:
+            self.stdout.write(output, ending='')
@@ -0,0 +1,54 @@
+"""
+Create or update email templates in bulk from a JSON or YAML file
+"""
+import io
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from emailmessagetemplates.models import EmailMessageTemplate
+
+MODEL = 'emailmessagetemplates.emailmessagetemplate'
+
+
+class Command(BaseCommand):
+    help = ("Create or update email templates from a JSON or YAML list of "
+            "templates, such as one written by export_templates or a fixture.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The file to import.")
+        parser.add_argument('--format', choices=('json', 'yaml'),
+                            help="The format of the file (by default, guessed "
+                            "from its extension).")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="The number of templates written at a time.")
+        parser.add_argument('--no-validate', action='store_false',
+                            dest='validate', help="Don't check the templates' "
+                            "syntax before importing them.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or \
+            ('yaml' if path.lower().endswith(('.yaml', '.yml')) else 'json')
+        with io.open(path, encoding='utf-8') as f:
+            if format == 'yaml':
+                try:
+                    import yaml
+                except ImportError:
+                    raise CommandError("PyYAML is required to import YAML.")
+                rows = yaml.safe_load(f)
+            else:
+                rows = json.load(f)
+
+        # Fixtures may include other models' objects
+        rows = [row for row in rows or [] if row.get('model', MODEL) == MODEL]
+        try:
+            counts = EmailMessageTemplate.objects.import_templates(
+                rows, batch_size=options['batch_size'],
+                validate=options['validate'])
+        except ValidationError as e:
+            raise CommandError("Nothing was imported:\n" + "\n".join(e.messages))
+
+        self.stdout.write("Created {created}, updated {updated} and left "
+                          "{unchanged} unchanged templates.".format(**counts))
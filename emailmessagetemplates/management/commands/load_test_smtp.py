@@ -0,0 +1,92 @@
+"""
+Send a template through a local SMTP sink at increasing concurrency, and
+report the throughput
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emailmessagetemplates.loadtest import SMTPSink, run_load_test
+from emailmessagetemplates.models import EmailMessageTemplate
+
+
+class Command(BaseCommand):
+    help = ("Send messages from a template with send_mail and send_mass_mail "
+            "to an SMTP server started on localhost that discards them, and "
+            "report the messages sent per second, connections used and errors "
+            "at each level of concurrency.  Nothing is delivered.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help="The name of the template to send.")
+        parser.add_argument('--context', default='{}',
+                            help="The context to render, as a JSON object.")
+        parser.add_argument('--count', type=int, default=1000,
+                            help="The number of messages sent by "
+                            "send_mass_mail at each concurrency.")
+        parser.add_argument('--send-mail-count', type=int, default=100,
+                            help="The number of messages sent one at a time "
+                            "by send_mail.")
+        parser.add_argument('--concurrency', default='1,2,4,8',
+                            help="The comma-separated numbers of connections "
+                            "to use.")
+        parser.add_argument('--chunk-size', type=int, default=10,
+                            help="The number of messages a connection takes "
+                            "at a time.")
+        parser.add_argument('--retries', type=int, default=3,
+                            help="The number of retries of a refused message.")
+        parser.add_argument('--backoff', type=float, default=0.1,
+                            help="The delay in seconds before a first retry.")
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help="Seconds the server takes to accept a message.")
+        parser.add_argument('--max-rate', type=int,
+                            help="Messages per second the server accepts "
+                            "before replying 421.")
+        parser.add_argument('--max-connections', type=int,
+                            help="Simultaneous connections the server accepts.")
+        parser.add_argument('--failure-rate', type=float, default=0.0,
+                            help="The proportion of messages the server refuses.")
+        parser.add_argument('--failure-code', type=int, default=451,
+                            choices=(421, 451, 554),
+                            help="The reply code of refused messages.")
+
+    def handle(self, *args, **options):
+        try:
+            context = json.loads(options['context'])
+            concurrency = [int(level) for level in
+                           options['concurrency'].split(',')]
+        except ValueError as e:
+            raise CommandError(e)
+        if not EmailMessageTemplate.objects.filter(
+                name=options['name'], enabled=True).exists():
+            raise CommandError("No enabled template named '%s' was found." %
+                               options['name'])
+
+        sink = SMTPSink(latency=options['latency'],
+                        max_rate=options['max_rate'],
+                        max_connections=options['max_connections'],
+                        failure_rate=options['failure_rate'],
+                        failure_code=options['failure_code'])
+        with sink:
+            results = run_load_test(
+                sink, options['name'], context=context, count=options['count'],
+                concurrency=concurrency,
+                send_mail_count=options['send_mail_count'],
+                scheduler_options={'chunk_size': options['chunk_size'],
+                                   'retries': options['retries'],
+                                   'backoff': options['backoff'],
+                                   'max_backoff': options['backoff'] * 16})
+        self.report(results)
+
+    def report(self, results):
+        self.stdout.write("%-15s %5s %7s %7s %8s %10s %6s %5s %7s %9s  %s" % (
+            "Helper", "Conns", "Sent", "Failed", "Time (s)", "Messages/s",
+            "Opened", "Peak", "Refused", "Throttled", "Errors"))
+        for result in results:
+            stats = result.stats
+            self.stdout.write("%-15s %5d %7d %7d %8.3f %10.1f %6d %5d %7d %9d  %s" % (
+                result.helper, result.concurrency, result.sent, result.failed,
+                result.duration, result.rate, stats.get('connections', 0),
+                stats.get('peak_connections', 0),
+                stats.get('refused_connections', 0), stats.get('throttled', 0),
+                ", ".join("%s: %d" % item for item in
+                          sorted(result.errors.items())) or "-"))
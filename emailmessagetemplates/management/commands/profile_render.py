@@ -0,0 +1,209 @@
+"""
+Render a bulk send without delivering it, and report how long it took
+"""
+import cProfile
+import csv
+import heapq
+import io
+import json
+import pstats
+import sys
+from collections import defaultdict
+from timeit import default_timer
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
+
+from emailmessagetemplates.models import EmailMessageTemplate
+from emailmessagetemplates.stats import percentile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PHASES = ('subject', 'html', 'text', 'mime')
+PERCENTILES = (50, 90, 99)
+
+
+class Command(BaseCommand):
+    help = ("Render a template against every context in a JSONL or CSV file "
+            "the way send_mass_mail does, without sending anything, and report "
+            "the time taken by each phase of rendering.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help="The name of the template to render.")
+        parser.add_argument('contexts', help="A file of contexts: one JSON "
+                            "object per line, or a CSV file with a header row.")
+        parser.add_argument('--related-object', metavar='APP_LABEL.MODEL:PK',
+                            help="The object the template is related to.")
+        parser.add_argument('--format', choices=('jsonl', 'csv'),
+                            help="The format of the contexts file (by default, "
+                            "guessed from its extension).")
+        parser.add_argument('--slowest', type=int, default=5, metavar='N',
+                            help="The number of slowest contexts to list.")
+        parser.add_argument('--profile', metavar='FILE',
+                            help="Profile rendering with cProfile and write the "
+                            "stats to FILE.")
+
+    def handle(self, *args, **options):
+        related_object = None
+        if options['related_object']:
+            related_object = self.get_related_object(options['related_object'])
+        try:
+            template = EmailMessageTemplate.objects.get_template(
+                options['name'], related_object)
+        except EmailMessageTemplate.DoesNotExist:
+            raise CommandError("No enabled template named '%s' was found." %
+                               options['name'])
+
+        path = options['contexts']
+        format = options['format'] or \
+            ('csv' if path.lower().endswith('.csv') else 'jsonl')
+        profiler = cProfile.Profile() if options['profile'] else None
+
+        self.times = defaultdict(list)
+        self.row_times = dict.fromkeys(PHASES, 0.0)
+        # Time the methods render_message calls to render each part
+        for phase, method in (('subject', 'render_subject'),
+                              ('html', 'render_html'), ('text', 'render_body')):
+            setattr(template, method, self.timed(phase, getattr(template, method)))
+
+        slowest, errors, size = [], defaultdict(int), 0
+        start = default_timer()
+        if profiler:
+            profiler.enable()
+        try:
+            for line, context in read_contexts(path, format):
+                for phase in PHASES:
+                    self.row_times[phase] = 0.0
+                try:
+                    # As send_mass_mail renders each message, and the email
+                    # backend then builds it
+                    message = template.render_message(
+                        context, ['recipient@example.com'])
+                    mime = self.timed('mime', message.as_bytes)()
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                    continue
+                size += len(mime)
+                total = sum(self.row_times.values())
+                for phase in PHASES:
+                    self.times[phase].append(self.row_times[phase])
+                self.times['total'].append(total)
+                heapq.heappush(slowest, (total, line, context))
+                if len(slowest) > options['slowest']:
+                    heapq.heappop(slowest)
+        finally:
+            if profiler:
+                profiler.disable()
+        elapsed = default_timer() - start
+
+        self.report(elapsed, size, errors, sorted(slowest, reverse=True))
+        if profiler:
+            self.report_profile(profiler, options['profile'])
+
+    def get_related_object(self, value):
+        """
+        Look up an object given as app_label.model:pk
+        """
+        try:
+            model, pk = value.rsplit(':', 1)
+            app_label, model = model.split('.', 1)
+            content_type = ContentType.objects.get_by_natural_key(
+                app_label, model.lower())
+            return content_type.get_object_for_this_type(pk=pk)
+        except ValueError:
+            raise CommandError("Give the related object as app_label.model:pk.")
+        except ObjectDoesNotExist:
+            raise CommandError("Related object '%s' doesn't exist." % value)
+
+    def timed(self, phase, func):
+        """
+        Wrap a function so the time spent in it is added to a phase of the
+        current row.
+        """
+        def timed(*args, **kwargs):
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.row_times[phase] += default_timer() - start
+        return timed
+
+    def report(self, elapsed, size, errors, slowest):
+        rendered = len(self.times['total'])
+        failed = sum(errors.values())
+        self.stdout.write("Rendered %d messages (%d failed) in %.3fs "
+                          "(%.1f messages/s)" % (rendered, failed, elapsed,
+                          (rendered + failed) / elapsed if elapsed else 0))
+        for error, count in sorted(errors.items()):
+            self.stdout.write("  %s: %d" % (error, count))
+        if not rendered:
+            return
+
+        self.stdout.write("")
+        self.stdout.write("%-8s %10s" % ("Phase", "Total (s)") + "".join(
+            "%10s" % ("p%d (ms)" % p) for p in PERCENTILES) + "%10s" % "Max (ms)")
+        for phase in PHASES + ('total',):
+            times = sorted(self.times[phase])
+            self.stdout.write("%-8s %10.3f" % (phase, sum(times)) + "".join(
+                "%10.3f" % (percentile(times, p) * 1000) for p in PERCENTILES) +
+                "%10.3f" % (times[-1] * 1000))
+
+        self.stdout.write("")
+        self.stdout.write("Bytes generated: %d (%.0f per message)" %
+                          (size, float(size) / rendered))
+        if resource:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Reported in kilobytes, except on OS X
+            if sys.platform != 'darwin':
+                peak *= 1024
+            self.stdout.write("Peak memory: %.1f MB" % (peak / 1048576.0))
+
+        self.stdout.write("")
+        self.stdout.write("Slowest contexts:")
+        for total, line, context in slowest:
+            self.stdout.write("  Line %d: %.3fms %s" % (
+                line, total * 1000, _truncate(json.dumps(context, default=repr))))
+
+    def report_profile(self, profiler, path):
+        profiler.dump_stats(path)
+        stream = six.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative')\
+            .print_stats(20)
+        self.stdout.write("")
+        self.stdout.write("Profile written to %s (timings above include "
+                          "profiling overhead)" % path)
+        self.stdout.write(stream.getvalue())
+
+
+def read_contexts(path, format):
+    """
+    Yields the line number and context of each row of a contexts file.
+    """
+    if format == 'csv':
+        with open(path, 'rb') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, dict(
+                    (key.decode('utf-8'), value.decode('utf-8'))
+                    for key, value in row.items())
+    else:
+        with io.open(path, encoding='utf-8') as f:
+            for line, text in enumerate(f, 1):
+                if not text.strip():
+                    continue
+                try:
+                    context = json.loads(text)
+                except ValueError as e:
+                    raise CommandError("Line %d isn't valid JSON: %s" % (line, e))
+                if not isinstance(context, dict):
+                    raise CommandError("Line %d isn't a JSON object." % line)
+                yield line, context
+
+
+def _truncate(text, length=100):
+    return text if len(text) <= length else text[:length - 3] + '...'
@@ -0,0 +1,122 @@
+"""
+A compact representation of a rendered templated message
+"""
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+from attachments import mime_part
+
+
+class RenderedMessage(object):
+    """
+    A message rendered from an EmailMessageTemplate, holding only the values
+    needed to send it.  It's used in place of copies of the template model for
+    bulk sends, and can be passed to any email backend's ``send_messages``: it
+    has the attributes of EmailMultiAlternatives that backends read, including
+    those that build the message themselves rather than calling ``message()``.
+
+    Instances use ``__slots__``, so don't carry an instance dictionary, model
+    state or the field values of the template they were rendered from; apart
+    from the rendered strings and address lists themselves, each message costs
+    a single fixed-size object.  The MIME message is only built when
+    ``message()`` is called, usually by the backend as the message is sent.
+
+    Attachments are kept as given rather than copied, so a list of 
+    SharedAttachments can be shared by every message of a bulk send, and are 
+    presented to backends as MIME parts.
+    """
+    __slots__ = ('subject', 'body', 'html', 'from_email', 'to', 'cc', 'bcc',
+                 'headers', '_attachments')
+
+    # Read by the email backends; messages always use DEFAULT_CHARSET, and 
+    # are sent through the connection the backend was called on
+    encoding = None
+    connection = None
+    content_subtype = 'plain'
+    mixed_subtype = 'mixed'
+    alternative_subtype = 'alternative'
+
+    def __init__(self, subject, body, from_email, to, cc=(), bcc=(),
+                 html=None, headers=None, attachments=()):
+        self.subject = subject
+        self.body = body
+        self.html = html
+        self.from_email = from_email
+        self.to = list(to)
+        self.cc = list(cc)
+        self.bcc = list(bcc)
+        self.headers = headers or None
+        self._attachments = attachments or ()
+
+    @property
+    def attachments(self):
+        """
+        The attachments as MIME parts, as on EmailMultiAlternatives
+        """
+        return [mime_part(attachment) for attachment in self._attachments]
+
+    @property
+    def extra_headers(self):
+        """
+        The extra headers of the message, as on EmailMultiAlternatives
+        """
+        return dict(self.headers or {})
+
+    @property
+    def reply_to(self):
+        """
+        Reply-To addresses, as on EmailMultiAlternatives (any Reply-To is set 
+        in the extra headers)
+        """
+        return []
+
+    @property
+    def alternatives(self):
+        """
+        The alternative content of the message, as on EmailMultiAlternatives
+        """
+        return [(self.html, 'text/html')] if self.html is not None else []
+
+    def email_message(self):
+        """
+        Returns an equivalent EmailMultiAlternatives instance.
+        """
+        email = EmailMultiAlternatives(self.subject, self.body, self.from_email,
+                                       self.to, self.bcc, cc=self.cc,
+                                       headers=self.headers,
+                                       attachments=self.attachments)
+        if self.html is not None:
+            email.attach_alternative(self.html, 'text/html')
+        return email
+
+    def message(self):
+        """
+        Build the MIME message to be sent.
+        """
+        return self.email_message().message()
+
+    def as_bytes(self):
+        """
+        Returns the MIME message as bytes, as Django's SMTP backend sends it 
+        (e.g. to write it to a spool file).
+        """
+        return self.message().as_bytes(linesep='\r\n')
+
+    def recipients(self):
+        """
+        Returns a list of all recipients of the email (includes direct
+        addressees as well as Cc and Bcc entries).
+        """
+        return [email for email in (self.to + self.cc + self.bcc) if email]
+
+    def send(self, fail_silently=False):
+        """
+        Sends the message with the default connection.
+        """
+        if not self.recipients():
+            return 0
+        connection = get_connection(fail_silently=fail_silently)
+        return connection.send_messages([self])
+
+    def __repr__(self):
+        return '<RenderedMessage: {0!r} to {1}>'.format(self.subject,
+                                                        ', '.join(self.to))
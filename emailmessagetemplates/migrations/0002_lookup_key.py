@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def lookup_key(name, content_type_id=None, object_id=None):
+    # The key format as of this migration
+    return u'{0}:{1}:{2}'.format('' if content_type_id is None else content_type_id,
+                                 '' if object_id is None else object_id, name)
+
+
+def populate_lookup_keys(apps, schema_editor):
+    EmailMessageTemplate = apps.get_model('emailmessagetemplates', 'EmailMessageTemplate')
+    for template in EmailMessageTemplate.objects.all().iterator():
+        EmailMessageTemplate.objects.filter(pk=template.pk).update(
+            lookup_key=lookup_key(template.name, template.content_type_id,
+                                  template.object_id))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emailmessagetemplates', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessagetemplate',
+            name='lookup_key',
+            field=models.CharField(default='', max_length=100, editable=False, db_index=True, blank=True),
+        ),
+        migrations.RunPython(populate_lookup_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import emailmessagetemplates.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emailmessagetemplates', '0002_lookup_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailTemplateFragment',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(help_text=b'The name templates use to include or extend this fragment, e.g. {% include "header" %}', unique=True, max_length=100)),
+                ('content', models.TextField(validators=[emailmessagetemplates.fields.validate_template_syntax])),
+                ('description', models.TextField(blank=True)),
+                ('edited_date', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ('name',),
+                'verbose_name': 'Email Template Fragment',
+            },
+        ),
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import emailmessagetemplates.fields
+
+
+# The fields saved in each version, as of this migration
+VERSIONED_FIELDS = ('type', 'subject_template', 'body_template_html',
+                    'autogenerate_text', 'body_template', 'sender', 'base_cc',
+                    'base_bcc')
+
+
+def create_first_versions(apps, schema_editor):
+    EmailMessageTemplate = apps.get_model('emailmessagetemplates', 'EmailMessageTemplate')
+    EmailMessageTemplateVersion = apps.get_model('emailmessagetemplates', 'EmailMessageTemplateVersion')
+    EmailMessageTemplate.objects.update(version=1)
+    for template in EmailMessageTemplate.objects.all().iterator():
+        EmailMessageTemplateVersion.objects.create(
+            template=template, version=1,
+            **dict((field, getattr(template, field)) for field in VERSIONED_FIELDS))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emailmessagetemplates', '0004_enabled_name_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailMessageTemplateVersion',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('version', models.PositiveIntegerField()),
+                ('type', models.CharField(default=b'text/plain', max_length=20, choices=[(b'text/plain', b'Text'), (b'text/html', b'HTML')])),
+                ('subject_template', models.CharField(max_length=2000)),
+                ('body_template_html', models.TextField(blank=True)),
+                ('autogenerate_text', models.BooleanField(default=True)),
+                ('body_template', models.TextField(blank=True)),
+                ('sender', models.EmailField(default=b'', max_length=75, blank=True)),
+                ('base_cc', emailmessagetemplates.fields.SeparatedValuesField(default=b'', blank=True)),
+                ('base_bcc', emailmessagetemplates.fields.SeparatedValuesField(default=b'', blank=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('template', models.ForeignKey(related_name='versions', on_delete=django.db.models.deletion.CASCADE, to='emailmessagetemplates.EmailMessageTemplate')),
+            ],
+            options={
+                'ordering': ('template', '-version'),
+                'verbose_name': 'Email Template Version',
+            },
+        ),
+        migrations.AddField(
+            model_name='emailmessagetemplate',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text=b'Increases each time the template is saved.', editable=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='emailmessagetemplateversion',
+            unique_together=set([('template', 'version')]),
+        ),
+        migrations.RunPython(create_first_versions, migrations.RunPython.noop),
+    ]
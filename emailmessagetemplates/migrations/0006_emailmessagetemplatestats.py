@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emailmessagetemplates', '0005_template_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailMessageTemplateStats',
+            fields=[
+                ('template', models.OneToOneField(related_name='stats', primary_key=True, serialize=False, on_delete=django.db.models.deletion.CASCADE, to='emailmessagetemplates.EmailMessageTemplate')),
+                ('render_count', models.BigIntegerField(default=0, help_text=b'The number of messages rendered.')),
+                ('slow_count', models.BigIntegerField(default=0, help_text=b'The number of parts that took longer than the slow render threshold.')),
+                ('total_size', models.BigIntegerField(default=0, help_text=b'The total length of the rendered parts, in characters.')),
+                ('subject_p50', models.FloatField(null=True, blank=True)),
+                ('subject_p95', models.FloatField(null=True, blank=True)),
+                ('html_p50', models.FloatField(null=True, blank=True)),
+                ('html_p95', models.FloatField(null=True, blank=True)),
+                ('text_p50', models.FloatField(null=True, blank=True)),
+                ('text_p95', models.FloatField(null=True, blank=True)),
+                ('updated_date', models.DateTimeField(null=True, blank=True)),
+            ],
+            options={
+                'verbose_name': 'Email Template Statistics',
+                'verbose_name_plural': 'Email Template Statistics',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('emailmessagetemplates', '0006_emailmessagetemplatestats'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='emailmessagetemplate',
+            index_together=set([]),
+        ),
+    ]
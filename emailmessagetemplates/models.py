@@ -1,7 +1,15 @@
-from django.db import models
+from collections import OrderedDict
+from timeit import default_timer as _clock
+
+from django.db import connections, models, router, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.core.exceptions import ValidationError
+from django.dispatch import receiver
 from django.core.mail import EmailMultiAlternatives
-from django.template import Context, Template
+from django.template import Context
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 
 try:
     # Django>=1.7
@@ -12,33 +20,152 @@ except ImportError:
     
 
 from conf import settings
-from fields import SeparatedValuesField, validate_template_syntax
+from fields import SeparatedValuesField, validate_template_syntax, \
+    check_template_syntax
+from message import RenderedMessage
+from engine import render_template, referenced_variables, \
+    clear_cache, fragments_changed
+from stats import render_stats
+
+# The fields import_templates sets, besides those identifying the template
+IMPORT_FIELDS = ('type', 'subject_template', 'body_template_html',
+                 'autogenerate_text', 'body_template', 'sender', 'base_cc',
+                 'base_bcc', 'description', 'enabled')
+TEMPLATE_FIELDS = ('subject_template', 'body_template', 'body_template_html')
+# The fields messages are rendered from, which are saved in each version
+VERSIONED_FIELDS = ('type', 'subject_template', 'body_template_html',
+                    'autogenerate_text', 'body_template', 'sender', 'base_cc',
+                    'base_bcc')
+
 
 class EmailMessageTemplateManager(models.Manager):
 
-    def get_template(self, name, related_object=None):
+    def get_template(self, name, related_object=None, version=None):
         """
         If a related object is specified, we'll first try to retrieve a template 
         that matches both the name and the object, and if none exists, we'll try 
         to retrieve a template with the specified name without a related object 
         instead (to support situations where some objects have a specialized 
         template, but, when none exists, we want to fall back to a default). 
+
+        Both templates are fetched in a single query on the indexed lookup key.
+
+        If a version number is given, the template is returned as it was at 
+        that version (see EmailMessageTemplate.get_version).
         """
+        keys = [lookup_key(name)]
         if related_object:
-            object_id = related_object.pk
             content_type = ContentType.objects.get_for_model(related_object)
-        else:
-            object_id = None
-            content_type = None
-        
-        try:
-            return self.get(name=name, object_id=object_id,
-                            content_type=content_type, enabled=True)
-        except EmailMessageTemplate.DoesNotExist:
-            if not related_object:
-                raise
-            return self.get(name=name, object_id=None, content_type=None,
-                            enabled=True)
+            keys.insert(0, lookup_key(name, content_type.pk, related_object.pk))
+
+        templates = dict((template.lookup_key, template) for template in
+                         self.filter(lookup_key__in=keys, enabled=True))
+        for key in keys:
+            if key in templates:
+                if version is not None:
+                    return templates[key].get_version(version)
+                return templates[key]
+        raise self.model.DoesNotExist(
+            "%s matching query does not exist." % self.model._meta.object_name)
+
+    def export_templates(self):
+        """
+        Returns a list of dictionaries describing each template, in the format 
+        import_templates accepts.
+        """
+        return [_export_row(template) for template in
+                self.select_related('content_type').iterator()]
+
+    def import_templates(self, rows, batch_size=500, validate=True):
+        """
+        Create or update templates in bulk from dictionaries in the format 
+        export_templates produces (entries from a fixture are accepted too).  
+        Templates are matched to existing ones by name and related object, and 
+        fields missing from a row are left as they are.
+
+        Rather than saving templates one at a time, each batch is written with 
+        bulk_create and bulk_update (along with a new version of each template 
+        created or changed), and the template caches are cleared once per 
+        batch; no signals are sent.  Unless validate is False, every 
+        template is parsed (but not rendered) first, and if any rows are 
+        invalid a ValidationError listing the problems is raised before 
+        anything is saved.
+
+        Returns a dictionary of the number of templates created, updated and 
+        unchanged.
+        """
+        rows = [dict(row.get('fields', row)) for row in rows]
+        if validate:
+            _validate_rows(self.model, rows)
+        counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+        with transaction.atomic(using=self.db):
+            for start in range(0, len(rows), batch_size):
+                self._import_batch(rows[start:start + batch_size], counts)
+                clear_cache()
+        return counts
+
+    def _import_batch(self, rows, counts):
+        # Later rows for the same template replace earlier ones
+        keyed = OrderedDict()
+        for row in rows:
+            content_type = _content_type(row.get('content_type'))
+            key = lookup_key(row['name'], content_type and content_type.pk,
+                             row.get('object_id'))
+            keyed[key] = (row, content_type)
+        # Locked so concurrent saves can't take the next version numbers
+        existing = dict((template.lookup_key, template) for template in
+                        self.select_for_update()
+                        .filter(lookup_key__in=list(keyed)))
+
+        now = timezone.now()
+        created, updated, updated_fields = [], [], set()
+        for key, (row, content_type) in keyed.items():
+            values = dict((field, self.model._meta.get_field(field)
+                           .to_python(row[field]))
+                          for field in IMPORT_FIELDS if field in row)
+            template = existing.get(key)
+            if template is None:
+                # bulk_create doesn't send pre_save, so set the lookup key here
+                template = self.model(name=row['name'],
+                                      content_type=content_type,
+                                      object_id=row.get('object_id'),
+                                      lookup_key=key, version=1, **values)
+                created.append(template)
+            else:
+                changed = _changed_fields(template, values)
+                if not changed:
+                    counts['unchanged'] += 1
+                    continue
+                for field in changed:
+                    setattr(template, field, values[field])
+                template.version += 1
+                updated.append(template)
+                updated_fields.update(changed)
+            # Not set automatically by bulk operations
+            template.edited_date = now
+
+        if created:
+            self.bulk_create(created)
+            if created[0].pk is None:
+                # Only some databases set primary keys in bulk_create
+                pks = dict(self.filter(lookup_key__in=[t.lookup_key for t in created])
+                           .values_list('lookup_key', 'pk'))
+                for template in created:
+                    template.pk = pks[template.lookup_key]
+        if updated:
+            # Only the fields that have changed are written
+            fields = [field for field in IMPORT_FIELDS
+                      if field in updated_fields] + ['version', 'edited_date']
+            if hasattr(self, 'bulk_update'):
+                # Django>=2.2
+                self.bulk_update(updated, fields)
+            else:
+                _bulk_update(self, updated, fields)
+        EmailMessageTemplateVersion.objects.bulk_create(
+            [EmailMessageTemplateVersion.snapshot(template)
+             for template in created + updated])
+        counts['created'] += len(created)
+        counts['updated'] += len(updated)
 
 
 class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
@@ -71,6 +198,8 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
     enabled = models.BooleanField(default=True, help_text="When unchecked, this email will not be sent.")
     edited_date = models.DateTimeField(auto_now=True, editable=False, blank=True)
     edited_user = models.TextField(max_length=30, editable=False, blank=True)
+    lookup_key = models.CharField(max_length=100, db_index=True, editable=False, blank=True, default='')
+    version = models.PositiveIntegerField(default=0, editable=False, help_text="Increases each time the template is saved.")
 
     objects = EmailMessageTemplateManager()
 
@@ -130,9 +259,7 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         Use the specified sender if set, and then fall back to the template 
         sender, and finally the setting value.
         """
-        return self._instance_from or self.sender or\
-            settings.EMAILMESSAGETEMPLATES_DEFAULT_FROM_EMAIL or\
-            settings.DEFAULT_FROM_EMAIL
+        return self._default_from(self._instance_from)
 
     @from_email.setter
     def from_email(self, value):
@@ -141,6 +268,16 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         """
         self._instance_from = value
 
+    def save(self, *args, **kwargs):
+        """
+        Save the template, numbering it as a new version and snapshotting it, 
+        in a single transaction.
+        """
+        using = kwargs.get('using') or router.db_for_write(type(self),
+                                                           instance=self)
+        with transaction.atomic(using=using):
+            super(EmailMessageTemplate, self).save(*args, **kwargs)
+
     def __unicode__(self):
         status = " (Disabled)" if not self.enabled else ""
         if self.related_object:
@@ -164,7 +301,7 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
 
     @property
     def subject(self):
-        return self.subject_prefix + Template(self.subject_template).render(self.context)
+        return self.render_subject(self.context)
 
     @subject.setter
     def subject(self, value):
@@ -175,13 +312,7 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
 
     @property
     def body(self):
-        if self.is_html_message() and self.autogenerate_text:
-            try:
-                import html2text
-                return html2text.html2text(self.html_content())
-            except ImportError:
-                pass
-        return Template(self.body_template).render(self.context)
+        return self.render_body(self.context)
 
     @body.setter
     def body(self, value):
@@ -194,10 +325,104 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         """
         Render the HTML message content, if any
         """
+        return self.render_html(self.context)
+
+    def render_subject(self, context):
+        """
+        Render the subject line (with any prefix) against a dictionary or 
+        Context
+        """
+        start = _clock()
+        subject = self.subject_prefix + render_template(self.subject_template,
+                                                        context)
+        render_stats.record(self, 'subject', _clock() - start, len(subject),
+                            context)
+        return subject
+
+    def render_body(self, context, html_content=None):
+        """
+        Render the plain text body against a dictionary or Context.  If the 
+        text is autogenerated from the HTML body, HTML content that has 
+        already been rendered can be passed in rather than rendering it again.
+        """
+        html2text = _html2text()
+        if self.is_html_message() and self.autogenerate_text and html2text:
+            if html_content is None:
+                html_content = self.render_html(context)
+            start = _clock()
+            body = html2text(html_content)
+            render_stats.record(self, 'text', _clock() - start, len(body),
+                                context)
+            return body
+        start = _clock()
+        body = render_template(self.body_template, context)
+        render_stats.record(self, 'text', _clock() - start, len(body), context)
+        return body
+
+    def render_html(self, context):
+        """
+        Render the HTML body against a dictionary or Context, if this is an 
+        HTML message
+        """
         if self.is_html_message():
-            return Template(self.body_template_html).render(self.context)
+            start = _clock()
+            html = render_template(self.body_template_html, context)
+            render_stats.record(self, 'html', _clock() - start, len(html),
+                                context)
+            return html
         return None
-    
+
+    def render_message(self, context, to, from_email=None, cc=(), bcc=(),
+                       headers=None, attachments=()):
+        """
+        Render the template against a context and return a RenderedMessage 
+        ready to be sent to the given recipients.  The template's CC and BCC 
+        addresses are added to any given, and the from address falls back to 
+        the template's sender as it does for the template itself.  The 
+        attachments (e.g. SharedAttachments) are referenced, not copied.
+        """
+        html_content = self.render_html(context)
+        if self.extra_headers:
+            headers = dict(self.extra_headers, **(headers or {}))
+
+        return RenderedMessage(
+            subject=self.render_subject(context),
+            body=self.render_body(context, html_content),
+            html=html_content,
+            from_email=self._default_from(from_email),
+            to=to,
+            cc=_merge_addresses(self.base_cc, cc),
+            bcc=_merge_addresses(self.base_bcc, bcc),
+            headers=headers,
+            attachments=attachments)
+
+    def referenced_variables(self):
+        """
+        Returns the set of context variable names used by the subject and body 
+        templates, or None if they can't be determined (e.g. when a template 
+        includes another chosen by a context variable).  Callers can use it to 
+        skip building context values the template doesn't need.
+        """
+        sources = [self.subject_template, self.body_template]
+        if self.is_html_message():
+            sources.append(self.body_template_html)
+        names = set()
+        for source in sources:
+            source_names = referenced_variables(source)
+            if source_names is None:
+                return None
+            names.update(source_names)
+        return frozenset(names)
+
+    def _default_from(self, from_email):
+        """
+        Use the specified sender if set, and then fall back to the template 
+        sender, and finally the setting value.
+        """
+        return from_email or self.sender or\
+            settings.EMAILMESSAGETEMPLATES_DEFAULT_FROM_EMAIL or\
+            settings.DEFAULT_FROM_EMAIL
+
     def is_html_message(self):
         return settings.EMAILMESSAGETEMPLATES_ALLOW_HTML_MESSAGES \
             and self.type == 'text/html'
@@ -207,23 +432,38 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         """
         Sends the email message.
         """
-        result = None
-        send_error = None
         try:
             html_content = self.html_content()
             if html_content is not None:
                 self.attach_alternative(html_content, "text/html")
-            result = super(EmailMessageTemplate, self).send(fail_silently=False)
-        except Exception as e:
-            raise
-            send_error = e
+            return super(EmailMessageTemplate, self).send(fail_silently=False)
+        except Exception:
+            #Raise an exception if the user has requested it
+            if not fail_silently:
+                raise
+        return 0
+    
+    @property
+    def cache_key(self):
+        """
+        A key for caching anything derived from the template's content: its 
+        ID and version, which changes whenever the template is saved.
+        """
+        return (self.pk, self.version)
 
-        #Raise an exception if the user has requested it
-        if not fail_silently and send_error:
-            raise send_error
+    def get_version(self, version):
+        """
+        Returns the template as it was at the given version, for rendering and 
+        sending messages with.  Unless that's the current version, this is a 
+        separate instance with the version's content, so a long-running send 
+        can keep using it while the template is edited; saving it restores 
+        that content as a new version.  Raises 
+        EmailMessageTemplateVersion.DoesNotExist for unknown versions.
+        """
+        if version == self.version:
+            return self
+        return self.versions.get(version=version).as_template(self)
 
-        return result
-    
     def related_item_display(self):
         return unicode(self.related_object) if self.related_object else 'None'
     related_item_display.short_description = "Related Item"
@@ -243,3 +483,293 @@ class EmailMessageTemplate(models.Model, EmailMultiAlternatives):
         unique_together = (("name", "content_type", "object_id"),)
         verbose_name = "Email Template"
         app_label = "emailmessagetemplates"
+
+
+class EmailTemplateFragment(models.Model):
+    """
+    A named piece of template content, such as a shared header or footer, that 
+    email templates can ``{% include %}`` or ``{% extends %}`` when the 
+    database template loader is configured.
+    """
+    name = models.CharField(max_length=100, unique=True, help_text="The name templates use to include or extend this fragment, e.g. {% include \"header\" %}")
+    content = models.TextField(validators=[validate_template_syntax])
+    description = models.TextField(blank=True)
+    edited_date = models.DateTimeField(auto_now=True, editable=False, blank=True)
+
+    def __unicode__(self):
+        return self.name
+
+    class Meta:
+        ordering = ('name',)
+        verbose_name = "Email Template Fragment"
+        app_label = "emailmessagetemplates"
+
+
+class EmailMessageTemplateVersion(models.Model):
+    """
+    An immutable snapshot of the fields a template renders messages from, 
+    saved each time the template is.  Each template's versions are numbered 
+    from 1.
+    """
+    template = models.ForeignKey(EmailMessageTemplate, related_name='versions', on_delete=models.CASCADE)
+    version = models.PositiveIntegerField()
+    type = models.CharField(max_length=20, choices=EmailMessageTemplate.CONTENT_TYPE_CHOICES, default='text/plain')
+    subject_template = models.CharField(max_length=2000)
+    body_template_html = models.TextField(blank=True)
+    autogenerate_text = models.BooleanField(default=True)
+    body_template = models.TextField(blank=True)
+    sender = models.EmailField(max_length=75, blank=True, default='')
+    base_cc = SeparatedValuesField(blank=True, default='')
+    base_bcc = SeparatedValuesField(blank=True, default='')
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def snapshot(cls, template):
+        """
+        Returns an unsaved snapshot of a template's current version.
+        """
+        return cls(template=template, version=template.version,
+                   **dict((field, getattr(template, field))
+                          for field in VERSIONED_FIELDS))
+
+    def as_template(self, template=None):
+        """
+        Returns an EmailMessageTemplate instance with this version's content 
+        and the current values of the template's other fields.
+        """
+        template = template or self.template
+        fields = template._meta.concrete_fields
+        values = dict((field.attname, getattr(template, field.attname))
+                      for field in fields)
+        values.update((field, getattr(self, field)) for field in VERSIONED_FIELDS)
+        values['version'] = self.version
+        return template.from_db(template._state.db,
+                                [field.attname for field in fields],
+                                [values[field.attname] for field in fields])
+
+    def __unicode__(self):
+        return u"{0} (version {1})".format(self.template, self.version)
+
+    class Meta:
+        ordering = ('template', '-version')
+        unique_together = (("template", "version"),)
+        verbose_name = "Email Template Version"
+        app_label = "emailmessagetemplates"
+
+
+class EmailMessageTemplateStats(models.Model):
+    """
+    Render statistics for a template, written periodically by each process 
+    rendering messages from it when EMAILMESSAGETEMPLATES_STATS is enabled.  
+    The percentiles (in milliseconds) are of the renders recorded by the 
+    process that wrote them most recently, since its previous write.
+    """
+    template = models.OneToOneField(EmailMessageTemplate, primary_key=True, related_name='stats', on_delete=models.CASCADE)
+    render_count = models.BigIntegerField(default=0, help_text="The number of messages rendered.")
+    slow_count = models.BigIntegerField(default=0, help_text="The number of parts that took longer than the slow render threshold.")
+    total_size = models.BigIntegerField(default=0, help_text="The total length of the rendered parts, in characters.")
+    subject_p50 = models.FloatField(null=True, blank=True)
+    subject_p95 = models.FloatField(null=True, blank=True)
+    html_p50 = models.FloatField(null=True, blank=True)
+    html_p95 = models.FloatField(null=True, blank=True)
+    text_p50 = models.FloatField(null=True, blank=True)
+    text_p95 = models.FloatField(null=True, blank=True)
+    updated_date = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def average_size(self):
+        """
+        The average size of a rendered message's parts, in characters
+        """
+        return self.total_size // self.render_count if self.render_count else 0
+
+    def __unicode__(self):
+        return u"Statistics for {0}".format(self.template)
+
+    class Meta:
+        verbose_name = "Email Template Statistics"
+        verbose_name_plural = "Email Template Statistics"
+        app_label = "emailmessagetemplates"
+
+
+@receiver(pre_save, sender=EmailMessageTemplate)
+def set_version(sender, instance, using, **kwargs):
+    """
+    Number each saved version of a template after the previous one.  The 
+    number is incremented in the template's row first, which locks the row 
+    until the save's transaction ends, so concurrent saves are numbered one 
+    after the other.
+    """
+    saved = sender._base_manager.using(using).filter(pk=instance.pk)
+    if instance.pk is not None and saved.update(version=F('version') + 1):
+        instance.version = saved.values_list('version', flat=True).get()
+    else:
+        instance.version = 1
+
+
+@receiver(post_save, sender=EmailMessageTemplate)
+def save_version(sender, instance, **kwargs):
+    """
+    Snapshot each version of a template as it's saved.
+    """
+    EmailMessageTemplateVersion.snapshot(instance).save()
+
+
+@receiver(pre_save, sender=EmailMessageTemplate)
+def set_lookup_key(sender, instance, **kwargs):
+    """
+    Keep the lookup key in step with the fields that identify the template 
+    (including when loading fixtures).  Note that it isn't updated by 
+    ``QuerySet.update`` or ``bulk_create``.
+    """
+    instance.lookup_key = lookup_key(instance.name, instance.content_type_id,
+                                     instance.object_id)
+
+
+@receiver(post_save, sender=EmailTemplateFragment)
+@receiver(post_delete, sender=EmailTemplateFragment)
+def invalidate_fragments(sender, **kwargs):
+    """
+    Discard cached templates so edits to fragments are picked up by the next 
+    message rendered, in this process and (through the shared cache) others.
+    """
+    fragments_changed()
+
+
+def lookup_key(name, content_type_id=None, object_id=None):
+    """
+    Combine the fields identifying a template into a single key, so templates 
+    with and without a related object can be found with one indexed lookup.
+    """
+    return u'{0}:{1}:{2}'.format('' if content_type_id is None else content_type_id,
+                                 '' if object_id is None else object_id, name)
+
+
+def _export_row(template):
+    """
+    Describe a template as a dictionary of its field values, identifying its 
+    related object's content type by natural key as fixtures do.
+    """
+    row = dict((field, getattr(template, field)) for field in IMPORT_FIELDS)
+    row.update(name=template.name, object_id=template.object_id,
+               content_type=list(template.content_type.natural_key())
+               if template.content_type_id else None,
+               base_cc=template.base_cc or [], base_bcc=template.base_bcc or [])
+    return row
+
+
+def _content_type(value):
+    """
+    Look up a content type given by natural key or primary key.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (list, tuple)):
+        return ContentType.objects.get_by_natural_key(*value)
+    return ContentType.objects.get_for_id(value)
+
+
+def _validate_rows(model, rows):
+    """
+    Check the templates to be imported, raising a ValidationError listing any 
+    problems.  Each distinct template string is only parsed once.
+    """
+    errors, checked = [], {}
+    types = dict(model.CONTENT_TYPE_CHOICES)
+    max_length = model._meta.get_field('name').max_length
+    for number, row in enumerate(rows, 1):
+        label = u"Template {0} ({1})".format(number, row.get('name'))
+        if not row.get('name'):
+            errors.append(u"{0}: a name is required.".format(label))
+        elif len(row['name']) > max_length:
+            errors.append(u"{0}: the name is longer than {1} characters."
+                          .format(label, max_length))
+        if row.get('type', 'text/plain') not in types:
+            errors.append(u"{0}: unknown type {1!r}.".format(label, row['type']))
+        try:
+            _content_type(row.get('content_type'))
+        except (ContentType.DoesNotExist, TypeError, ValueError):
+            errors.append(u"{0}: unknown content type {1!r}.".format(
+                label, row['content_type']))
+        for field in TEMPLATE_FIELDS:
+            source = row.get(field) or ''
+            if source not in checked:
+                try:
+                    check_template_syntax(source)
+                    checked[source] = None
+                except ValidationError as e:
+                    checked[source] = e.messages[0]
+            if checked[source]:
+                errors.append(u"{0}: {1}: {2}".format(label, field,
+                                                      checked[source]))
+    if errors:
+        raise ValidationError(errors)
+
+
+def _changed_fields(template, values):
+    """
+    The names of the fields whose given values differ from the template's
+    """
+    changed = []
+    for name, value in values.items():
+        field = template._meta.get_field(name)
+        if field.get_prep_value(getattr(template, name)) != \
+                field.get_prep_value(value):
+            changed.append(name)
+    return changed
+
+
+def _bulk_update(manager, objs, fields):
+    """
+    Update fields of many objects with a query per batch, as 
+    QuerySet.bulk_update does in Django>=2.2.  Objects sharing a field's value 
+    are grouped into a single condition, so fields set to the same value 
+    across the batch are updated without a CASE expression at all.
+    """
+    model_fields = [manager.model._meta.get_field(name) for name in fields]
+    # Each object adds at most two parameters per field, plus its primary key
+    batch_size = max(connections[manager.db].ops.bulk_batch_size(
+        ['pk'] * (2 * len(fields) + 1), objs), 1)
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        updates = {}
+        for field in model_fields:
+            groups = OrderedDict()
+            for obj in batch:
+                value = getattr(obj, field.attname)
+                groups.setdefault(field.get_prep_value(value),
+                                  (value, []))[1].append(obj.pk)
+            if len(groups) == 1:
+                updates[field.attname] = Value(value, output_field=field)
+            else:
+                updates[field.attname] = Case(*[
+                    When(pk__in=pks, then=Value(group_value, output_field=field))
+                    for group_value, pks in groups.values()], output_field=field)
+        manager.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
+
+
+def _html2text():
+    """
+    The html2text function, or None if html2text isn't installed.  The import 
+    is only attempted once, rather than on every render.
+    """
+    global _html2text_function
+    if _html2text_function is _unset:
+        try:
+            from html2text import html2text
+        except ImportError:
+            html2text = None
+        _html2text_function = html2text
+    return _html2text_function
+
+_unset = object()
+_html2text_function = _unset
+
+
+def _merge_addresses(base, extra):
+    """
+    Combine a template's address list with the addresses given for a message, 
+    without duplicates.
+    """
+    addresses = list(base or [])
+    return addresses + [a for a in extra or [] if a not in addresses]
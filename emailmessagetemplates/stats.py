@@ -0,0 +1,146 @@
+"""
+Collecting render statistics for templates
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from timeit import default_timer as _clock
+
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import F
+from django.template import Context
+from django.utils import timezone
+
+from conf import settings
+
+logger = logging.getLogger(__name__)
+
+PARTS = ('subject', 'html', 'text')
+
+# The number of recent render times kept for each part of a template between
+# flushes, from which its percentiles are calculated
+SAMPLE_SIZE = 1000
+
+# How often the background thread checks whether the flush interval has passed
+CHECK_INTERVAL = 0.1
+
+
+class RenderStats(object):
+    """
+    Aggregates the render times and output sizes of each template in memory, 
+    and writes them to the database in a batch every 
+    EMAILMESSAGETEMPLATES_STATS_FLUSH_INTERVAL seconds (and when the process 
+    exits), rather than on every render.  Batches are written by a background 
+    thread, started when the first render is recorded, so rendering (often in 
+    a DeliveryScheduler worker thread) never waits on the database.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.thread = None
+
+    def record(self, template, part, seconds, size, context):
+        """
+        Record the time taken to render a part ('subject', 'html' or 'text') 
+        of a message from a template, and the size of the result.
+        """
+        threshold = settings.EMAILMESSAGETEMPLATES_SLOW_RENDER_THRESHOLD
+        slow = threshold is not None and seconds >= threshold
+        if slow:
+            if isinstance(context, Context):
+                context = context.flatten()
+            logger.warning("Rendering the %s of template %r (ID %s) took %.3fs; "
+                           "context keys: %s", part, template.name, template.pk,
+                           seconds, ", ".join(sorted(context or ())))
+        if not settings.EMAILMESSAGETEMPLATES_STATS or template.pk is None:
+            return
+
+        with self.lock:
+            entry = self.pending.get(template.pk)
+            if entry is None:
+                entry = self.pending[template.pk] = _Entry()
+            entry.times[part].append(seconds)
+            entry.size += size
+            entry.slow += slow
+            # Every message has a subject
+            entry.count += part == 'subject'
+            # Also restarts the thread in a process forked from this one
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._flush_periodically,
+                                               name='emailmessagetemplates-stats')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _flush_periodically(self):
+        last_flush = _clock()
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            interval = settings.EMAILMESSAGETEMPLATES_STATS_FLUSH_INTERVAL
+            if _clock() - last_flush < interval:
+                continue
+            last_flush = _clock()
+            try:
+                self.flush()
+            finally:
+                # Django only closes the connections of request threads
+                connections.close_all()
+
+    def flush(self):
+        """
+        Write the statistics recorded since the last flush to the database.
+        """
+        from models import EmailMessageTemplateStats
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for pk, entry in pending.items():
+            counts = {'render_count': entry.count, 'slow_count': entry.slow,
+                      'total_size': entry.size}
+            values = {'updated_date': timezone.now()}
+            for part, times in entry.times.items():
+                if times:
+                    times = sorted(times)
+                    values[part + '_p50'] = percentile(times, 50) * 1000
+                    values[part + '_p95'] = percentile(times, 95) * 1000
+            increments = dict((name, F(name) + count)
+                              for name, count in counts.items())
+            increments.update(values)
+            try:
+                stats = EmailMessageTemplateStats.objects.filter(template_id=pk)
+                if not stats.update(**increments):
+                    try:
+                        with transaction.atomic():
+                            EmailMessageTemplateStats.objects.create(
+                                template_id=pk, **dict(values, **counts))
+                    except IntegrityError:
+                        # Created by another process in the meantime
+                        stats.update(**increments)
+            except DatabaseError:
+                # Losing statistics mustn't stop messages being rendered
+                logger.exception("Couldn't save the render statistics of "
+                                 "template %s", pk)
+
+
+class _Entry(object):
+    """
+    The statistics recorded for a template since the last flush
+    """
+    __slots__ = ('count', 'slow', 'size', 'times')
+
+    def __init__(self):
+        self.count = self.slow = self.size = 0
+        self.times = dict((part, deque(maxlen=SAMPLE_SIZE)) for part in PARTS)
+
+
+def percentile(times, p):
+    """
+    The p-th percentile of a sorted list of times (by the nearest rank method)
+    """
+    return times[max(int(round(p / 100.0 * len(times))) - 1, 0)]
+
+
+render_stats = RenderStats()
+atexit.register(render_stats.flush)
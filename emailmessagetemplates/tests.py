@@ -1,17 +1,64 @@
+import errno
+import itertools
+import json
+import logging
+import os
+import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from email.mime.base import MIMEBase
 from datetime import datetime, timedelta
+from unittest import skipUnless
 
-from django.core.management import call_command
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import mock
+from django.core.cache import caches
+from django.core.management import call_command, CommandError
 from django.core import mail
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.contrib.admin.sites import AdminSite
+from django.contrib.admin.utils import lookup_field
+from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
-from django.template import Context
+from django.template import Context, engines
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from django.utils.six import StringIO
 
-from models import EmailMessageTemplate
+import models
+from models import EmailMessageTemplate, EmailMessageTemplateVersion, \
+    EmailMessageTemplateStats, EmailTemplateFragment, lookup_key
 from fields import validate_template_syntax
-from utils import send_mail, send_mass_mail, mail_admins, mail_managers
+from admin import EmailMessageTemplateAdmin
+from engine import FRAGMENTS_KEY, get_engine, get_template, clear_cache, \
+    referenced_variables
+from context import Lazy
+from attachments import SharedAttachment
+from stats import render_stats, logger as stats_logger
+import loadtest
+from loadtest import SMTPSink
+from utils import send_mail, send_mass_mail, render_mass_mail, mail_admins, \
+    mail_managers
+from message import RenderedMessage
+from delivery import TokenBucket, DeliveryScheduler, Relay, \
+    is_temporary_error, _Dispatcher
 
 class TemplateRetrievalTest(TestCase):
     """
@@ -72,6 +119,29 @@ class TemplateRetrievalTest(TestCase):
         template = EmailMessageTemplate.objects.get_template("Template 2", related_object=site)
         self.assertEqual(template.pk, 2)
 
+    def test_retrieve_fallback_single_query(self):
+        """
+        Ensure the object and fallback templates are retrieved with a single 
+        query
+        """
+        site = Site.objects.get(pk=2)
+        ContentType.objects.get_for_model(site)
+        with self.assertNumQueries(1):
+            template = EmailMessageTemplate.objects.get_template("Template 1", related_object=site)
+        self.assertEqual(template.pk, 1)
+
+    def test_lookup_key(self):
+        """Ensure the lookup key is kept in step with the identifying fields"""
+        site = Site.objects.get(pk=1)
+        template = EmailMessageTemplate.objects.get_template("Template 1", related_object=site)
+        self.assertEqual(template.lookup_key, lookup_key("Template 1",
+            ContentType.objects.get_for_model(site).pk, 1))
+
+        template.name = "Renamed"
+        template.save()
+        self.assertEqual(EmailMessageTemplate.objects.get_template("Renamed", site).pk,
+                         template.pk)
+
 
 class TemplatePreparationTest(TestCase):
     """
@@ -444,3 +514,1525 @@ class UtilityFunctionTest(TestCase):
         self.assertEqual(mail.outbox[0].body, "Test 1 body *WORLD*")
         self.assertEqual(mail.outbox[0].to, ['admin1@example.com', 
                                              'admin2@example.com'])
+
+
+class FakeClock(object):
+    """A clock for the rate limiter that only advances when slept on"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FlakyConnection(object):
+    """
+    A connection that fails with the given errors before delivering messages 
+    to the outbox
+    """
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.opened = self.closed = 0
+        self.sent = []
+
+    def open(self):
+        self.opened += 1
+        return True
+
+    def close(self):
+        self.closed += 1
+
+    def send_messages(self, messages):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.extend(messages)
+        return len(messages)
+
+
+class DeliverySchedulerTest(TestCase):
+    """
+    Ensure that bulk deliveries respect the configured rate limit, connection 
+    cap and retry behavior
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def test_token_bucket_rate(self):
+        """Ensure the token bucket paces consumers to the configured rate"""
+        clock = FakeClock()
+        bucket = TokenBucket(10, capacity=1, clock=clock, sleep=clock.sleep)
+        for i in range(21):
+            bucket.consume()
+        self.assertAlmostEqual(clock.now, 2.0)
+
+    def test_token_bucket_adapts(self):
+        """Ensure the rate halves on errors and recovers on success"""
+        clock = FakeClock()
+        bucket = TokenBucket(10, clock=clock, sleep=clock.sleep)
+        bucket.slow_down()
+        self.assertEqual(bucket.rate, 5)
+        for i in range(20):
+            bucket.speed_up()
+        self.assertEqual(bucket.rate, 10)
+
+    def test_temporary_errors(self):
+        """Ensure 4xx replies are retryable and 5xx replies aren't"""
+        self.assertTrue(is_temporary_error(
+            smtplib.SMTPDataError(421, 'Too many messages')))
+        self.assertTrue(is_temporary_error(
+            smtplib.SMTPServerDisconnected()))
+        self.assertFalse(is_temporary_error(
+            smtplib.SMTPDataError(554, 'Rejected')))
+        self.assertFalse(is_temporary_error(
+            smtplib.SMTPRecipientsRefused({'a@example.com': (550, 'No')})))
+
+    def test_retry_temporary_error(self):
+        """Ensure messages are retried with backoff after a temporary error"""
+        clock = FakeClock()
+        connection = FlakyConnection([smtplib.SMTPDataError(451, 'Slow down')])
+        scheduler = DeliveryScheduler(rate=100, retries=2, backoff=1,
+                                      sleep=clock.sleep)
+        result = scheduler.deliver(['a', 'b'], lambda: connection)
+
+        self.assertEqual(result.sent, 2)
+        self.assertEqual([row.attempts for row in result], [2, 1])
+        self.assertEqual(connection.sent, ['a', 'b'])
+        self.assertTrue(any(0.5 <= s <= 1 for s in clock.sleeps))
+        self.assertEqual((connection.opened, connection.closed), (1, 1))
+
+    def test_permanent_error(self):
+        """
+        Ensure permanent errors aren't retried, and don't prevent other 
+        messages being sent
+        """
+        connection = FlakyConnection([smtplib.SMTPDataError(554, 'Rejected')])
+        scheduler = DeliveryScheduler(retries=2, backoff=0)
+        result = scheduler.deliver(['a', 'b'], lambda: connection)
+
+        self.assertEqual((result.sent, result.failed), (1, 1))
+        self.assertEqual(result.rows[0].status, 'failed')
+        self.assertEqual(result.rows[0].attempts, 1)
+        self.assertEqual(result.rows[0].error_class, 'SMTPDataError')
+        self.assertEqual(result.rows[1].status, 'sent')
+        self.assertEqual(connection.sent, ['b'])
+
+    def test_retries_exhausted(self):
+        """Ensure a message that keeps failing is eventually reported"""
+        errors = [smtplib.SMTPDataError(451, 'Slow down')] * 3
+        connection = FlakyConnection(errors)
+        scheduler = DeliveryScheduler(retries=2, backoff=0)
+        result = scheduler.deliver(['a'], lambda: connection)
+
+        self.assertEqual(result.failed, 1)
+        self.assertEqual(result.rows[0].attempts, 3)
+        self.assertEqual(result.error_counts(), {'SMTPDataError': 1})
+
+    def test_concurrent_delivery(self):
+        """Ensure concurrent workers each use their own connection"""
+        connections = []
+
+        def factory():
+            connections.append(FlakyConnection())
+            return connections[-1]
+
+        scheduler = DeliveryScheduler(concurrency=3)
+        result = scheduler.deliver(range(30), factory)
+
+        self.assertEqual(result.sent, 30)
+        self.assertEqual([row.index for row in result], list(range(30)))
+        self.assertTrue(1 <= len(connections) <= 3)
+        self.assertEqual(sorted(m for c in connections for m in c.sent),
+                         list(range(30)))
+
+    def test_send_mass_mail_settings(self):
+        """Ensure send_mass_mail delivers through the configured scheduler"""
+        datatuple = [(self.context, 'from@example.com', ['to%s@example.com' % i])
+                     for i in range(5)]
+        with self.settings(EMAILMESSAGETEMPLATES_SEND_RATE=1000,
+                           EMAILMESSAGETEMPLATES_SEND_CONCURRENCY=2):
+            sent = send_mass_mail("Template 1", datatuple=datatuple)
+
+        self.assertEqual(sent, 5)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['to%s@example.com' % i for i in range(5)])
+
+    def test_send_mass_mail_connection(self):
+        """Ensure a connection passed to send_mass_mail is used for all messages"""
+        connection = FlakyConnection()
+        datatuple = [(self.context, 'from@example.com', ['to@example.com'])] * 3
+        with self.settings(EMAILMESSAGETEMPLATES_SEND_CONCURRENCY=4):
+            sent = send_mass_mail("Template 1", datatuple=datatuple,
+                                  connection=connection)
+
+        self.assertEqual(sent, 3)
+        self.assertEqual(len(connection.sent), 3)
+
+
+class BulkResultTest(TestCase):
+    """
+    Ensure that bulk sends report the outcome of each row, and that failed rows 
+    don't affect the rest of the send
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.datatuple = [
+            ({'hello': 'row %s' % i}, 'from@example.com', ['to%s@example.com' % i])
+            for i in range(4)]
+
+    def test_result_rows(self):
+        """Ensure each row is reported in order with its status and timing"""
+        result = send_mass_mail("Template 1", datatuple=self.datatuple,
+                                return_result=True)
+
+        self.assertEqual(len(result), 4)
+        self.assertEqual(int(result), 4)
+        self.assertEqual([row.status for row in result], ['sent'] * 4)
+        self.assertTrue(all(row.duration >= 0 for row in result))
+        self.assertEqual(result.failed_rows(self.datatuple), [])
+
+    def test_failed_rows(self):
+        """Ensure failures are isolated and the failed rows can be retried"""
+        connection = FlakyConnection()
+        send_messages = connection.send_messages
+
+        def reject_second(messages):
+            if messages[0].to == ['to1@example.com']:
+                raise smtplib.SMTPRecipientsRefused(
+                    {'to1@example.com': (550, 'Unknown user')})
+            return send_messages(messages)
+        connection.send_messages = reject_second
+
+        result = send_mass_mail("Template 1", datatuple=self.datatuple,
+                                connection=connection, return_result=True)
+
+        self.assertEqual((result.sent, result.failed), (3, 1))
+        self.assertEqual(result.failures[0].index, 1)
+        self.assertEqual(result.failures[0].error_class,
+                         'SMTPRecipientsRefused')
+        self.assertEqual(result.failed_rows(self.datatuple),
+                         [self.datatuple[1]])
+        self.assertEqual(len(connection.sent), 3)
+
+    def test_failure_raised(self):
+        """
+        Ensure the error is raised after the other rows are sent when a result 
+        isn't requested, unless failing silently
+        """
+        connection = FlakyConnection([smtplib.SMTPDataError(554, 'Rejected')])
+        self.assertRaises(smtplib.SMTPDataError, send_mass_mail, "Template 1",
+                          datatuple=self.datatuple, connection=connection)
+        self.assertEqual(len(connection.sent), 3)
+
+        connection = FlakyConnection([smtplib.SMTPDataError(554, 'Rejected')])
+        sent = send_mass_mail("Template 1", datatuple=self.datatuple,
+                              connection=connection, fail_silently=True)
+        self.assertEqual(sent, 3)
+
+    def raised_from(self, *args, **kwargs):
+        """
+        The names of the functions in the traceback of the error raised by 
+        send_mass_mail
+        """
+        try:
+            send_mass_mail("Template 1", datatuple=self.datatuple, *args,
+                           **kwargs)
+        except Exception:
+            return [frame[2] for frame in
+                    traceback.extract_tb(sys.exc_info()[2])]
+        self.fail("No error was raised")
+
+    def test_failure_traceback(self):
+        """
+        Ensure the error raised keeps the traceback of where the message 
+        failed, whether sending it or connecting
+        """
+        connection = FlakyConnection([smtplib.SMTPDataError(554, 'Rejected')])
+        self.assertEqual(self.raised_from(connection=connection)[-1],
+                         'send_messages')
+
+        connection = FlakyConnection()
+        connection.open = mock.Mock(side_effect=socket.error(errno.ECONNREFUSED,
+                                                             'Refused'))
+        self.assertTrue('_connect' in self.raised_from(
+            connection=connection, scheduler=DeliveryScheduler(retries=0)))
+
+    def test_send_fail_silently(self):
+        """Ensure errors sending a single template are only raised if requested"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.to = ['to@example.com']
+        template.connection = FlakyConnection([smtplib.SMTPDataError(554, 'No')])
+        self.assertEqual(template.send(fail_silently=True), 0)
+
+        template.connection = FlakyConnection([smtplib.SMTPDataError(554, 'No')])
+        self.assertRaises(smtplib.SMTPDataError, template.send)
+
+
+class RelayFanOutTest(TestCase):
+    """
+    Ensure that bulk sends can be spread across several relays, in proportion 
+    to their weights, and fail over when a relay can't be reached
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.datatuple = [
+            ({'hello': 'row %s' % i}, 'from@example.com', ['to%s@example.com' % i])
+            for i in range(40)]
+
+    def relay(self, weight=1, errors=()):
+        connection = FlakyConnection(errors)
+        send_messages = connection.send_messages
+
+        def slow_send_messages(messages):
+            time.sleep(0.001)
+            return send_messages(messages)
+        connection.send_messages = slow_send_messages
+        return connection, Relay(lambda: connection, weight=weight,
+                                 concurrency=1)
+
+    def test_relay_config(self):
+        """Ensure relays can be configured with get_connection arguments"""
+        relay = Relay.from_config({
+            'backend': 'django.core.mail.backends.locmem.EmailBackend',
+            'weight': 3, 'concurrency': 2})
+        self.assertEqual((relay.weight, relay.concurrency), (3, 2))
+        self.assertEqual(relay.connection_factory().__class__.__name__,
+                         'EmailBackend')
+
+    def test_weighted_assignment(self):
+        """Ensure chunks are assigned to relays according to their weight"""
+        relay1 = Relay(None, weight=3)
+        relay2 = Relay(None, weight=1)
+        dispatcher = _Dispatcher(range(8), [relay1, relay2], 1)
+        chunks = [dispatcher.next_chunk(relay1) for i in range(6)]
+
+        self.assertEqual(len(dispatcher.queues[relay2]), 2)
+        # Once the messages run out, idle relays take other relays' chunks
+        self.assertEqual(len(chunks + [dispatcher.next_chunk(relay1),
+                                       dispatcher.next_chunk(relay1)]), 8)
+        self.assertEqual(dispatcher.next_chunk(relay2), None)
+
+    def test_fan_out(self):
+        """Ensure messages are sent through all the relays concurrently"""
+        connection1, relay1 = self.relay(weight=3)
+        connection2, relay2 = self.relay(weight=1)
+        scheduler = DeliveryScheduler(chunk_size=1)
+        result = send_mass_mail("Template 1", datatuple=self.datatuple,
+                                scheduler=scheduler, return_result=True,
+                                connections=[relay1, relay2])
+
+        self.assertEqual(result.sent, 40)
+        self.assertEqual(len(connection1.sent) + len(connection2.sent), 40)
+        self.assertTrue(connection1.sent and connection2.sent)
+
+    def test_fan_out_configs(self):
+        """Ensure connection configurations can be passed to send_mass_mail"""
+        backend = 'django.core.mail.backends.locmem.EmailBackend'
+        sent = send_mass_mail("Template 1", datatuple=self.datatuple,
+                              connections=[{'backend': backend},
+                                           {'backend': backend, 'weight': 2}])
+        self.assertEqual(sent, 40)
+        self.assertEqual(len(mail.outbox), 40)
+
+    def test_failover(self):
+        """Ensure messages fail over to other relays if one is unreachable"""
+        def unreachable():
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+        connection, relay = self.relay()
+        scheduler = DeliveryScheduler(chunk_size=5, retries=1, backoff=0)
+        result = scheduler.deliver(range(20), relays=[
+            Relay(unreachable, weight=5, concurrency=1), relay])
+
+        self.assertEqual(result.sent, 20)
+        self.assertEqual(sorted(connection.sent), list(range(20)))
+
+    def test_slow_failover(self):
+        """Ensure messages of a relay that's slow to fail aren't lost"""
+        def unreachable():
+            time.sleep(0.3)
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+        connection, relay = self.relay()
+        scheduler = DeliveryScheduler(chunk_size=5, retries=0)
+        result = scheduler.deliver(range(20), relays=[
+            Relay(unreachable, concurrency=1), relay])
+
+        self.assertEqual([row.index for row in result], list(range(20)))
+        self.assertEqual(result.sent, 20)
+        self.assertEqual(sorted(connection.sent), list(range(20)))
+
+    def test_connection_limit(self):
+        """Ensure a refused connection only stops the worker that opened it"""
+        connection, relay = self.relay()
+        connections = [connection]
+
+        def limited():
+            if connections:
+                return connections.pop()
+            raise smtplib.SMTPConnectError(421, 'Too many connections')
+        scheduler = DeliveryScheduler(chunk_size=5, retries=1, backoff=0)
+        result = scheduler.deliver(range(40), relays=[
+            Relay(limited, concurrency=3)])
+
+        self.assertEqual(result.sent, 40)
+        self.assertEqual(sorted(connection.sent), list(range(40)))
+
+    def test_all_relays_down(self):
+        """Ensure every message fails if no relay can be reached"""
+        def unreachable():
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+        scheduler = DeliveryScheduler(chunk_size=3, retries=0)
+        result = scheduler.deliver(range(10), relays=[
+            Relay(unreachable, concurrency=2), Relay(unreachable)])
+
+        self.assertEqual([row.index for row in result], list(range(10)))
+        self.assertEqual(result.failed, 10)
+        self.assertEqual(result.error_counts().keys(), ['error'])
+
+
+class RenderedMessageTest(TestCase):
+    """
+    Ensure that templates can be rendered to compact messages that send the 
+    same content as the template itself
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def test_backend_attributes(self):
+        """
+        Ensure messages have the attributes of EmailMultiAlternatives that 
+        backends read, with attachments as MIME parts
+        """
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        message = template.render_message(
+            self.context, ['to@example.com'], headers={'Reply-To': 'a@b.com'},
+            attachments=[SharedAttachment(content='Notes', filename='n.txt')])
+        email = message.email_message()
+
+        for name in ('subject', 'body', 'from_email', 'to', 'cc', 'bcc',
+                     'reply_to', 'extra_headers', 'alternatives', 'encoding',
+                     'content_subtype', 'mixed_subtype', 'alternative_subtype'):
+            self.assertEqual(getattr(message, name), getattr(email, name), name)
+        self.assertEqual(message.connection, None)
+        attachment, = message.attachments
+        self.assertTrue(isinstance(attachment, MIMEBase))
+        self.assertEqual(attachment.get_payload(decode=True), 'Notes')
+
+    def test_render_message(self):
+        """Ensure the rendered message has the template's content and addresses"""
+        template = EmailMessageTemplate.objects.get_template("Template 2")
+        message = template.render_message(self.context, ['to@example.com'],
+                                          cc=['a@example.com', 'e@example.com'])
+
+        self.assertEqual(message.subject, "Test 2 Subject *HELLO*")
+        self.assertEqual(message.body, "Test 2 body *WORLD*")
+        self.assertEqual(message.from_email, 'example@example.com')
+        self.assertEqual(message.to, ['to@example.com'])
+        self.assertEqual(message.cc, ['a@example.com', 'b@example.com',
+                                      'e@example.com'])
+        self.assertEqual(message.bcc, ['c@example.com', 'd@example.com'])
+        self.assertEqual(len(message.recipients()), 6)
+
+    def test_render_html_message(self):
+        """Ensure HTML content is rendered once and sent as an alternative"""
+        with self.settings(EMAILMESSAGETEMPLATES_ALLOW_HTML_MESSAGES=True):
+            template = EmailMessageTemplate.objects.get_template("Template 5")
+            message = template.render_message(self.context, ['to@example.com'],
+                                              'from@example.com')
+        mime = message.message()
+
+        self.assertEqual(mime.get_content_type(), 'multipart/alternative')
+        self.assertTrue("# *HELLO* *WORLD* in HTML!" in message.body)
+        self.assertTrue("<h1>*HELLO* *WORLD* in HTML!</h1>" in
+                        mime.get_payload(1).as_string())
+
+    def test_send_rendered_message(self):
+        """Ensure rendered messages can be sent like an EmailMessage"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        message = template.render_message(self.context, ['to@example.com'],
+                                          headers={'X-Campaign': 'test'})
+        message.send()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Test 1 Subject *HELLO*')
+        self.assertEqual(mail.outbox[0].message()['X-Campaign'], 'test')
+
+    def test_mass_mail_messages(self):
+        """Ensure send_mass_mail sends rendered messages, not template copies"""
+        datatuple = [(self.context, 'from@example.com', ['to@example.com'])]
+        send_mass_mail("Template 1", datatuple=datatuple)
+
+        self.assertTrue(isinstance(mail.outbox[0], RenderedMessage))
+
+    def test_message_size(self):
+        """
+        Ensure rendered messages don't carry an instance dictionary and are 
+        much smaller than the template they were rendered from
+        """
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        message = template.render_message(self.context, ['to@example.com'])
+
+        self.assertFalse(hasattr(message, '__dict__'))
+        self.assertTrue(sys.getsizeof(message) * 4 <
+                        sys.getsizeof(template) + sys.getsizeof(template.__dict__))
+
+
+@skipUnless(os.environ.get('EMAILMESSAGETEMPLATES_BENCHMARKS'),
+            "Set EMAILMESSAGETEMPLATES_BENCHMARKS=1 to run benchmarks")
+class TemplateLookupBenchmark(TestCase):
+    """
+    Ensure the cost of looking up a template stays flat as the number of 
+    per-object templates grows
+    """
+    fixtures = ['test_templates',]
+    sizes = (1000, 10000, 100000, 300000)
+    lookups = 500
+
+    def add_templates(self, content_type, start, stop):
+        EmailMessageTemplate.objects.bulk_create([
+            EmailMessageTemplate(name="Template 1", content_type=content_type,
+                                 object_id=object_id, subject_template="Subject",
+                                 lookup_key=lookup_key("Template 1",
+                                                       content_type.pk, object_id))
+            for object_id in range(start, stop)])
+
+    def time_lookups(self, content_type, count):
+        """The median time of a lookup for an object and for the fallback"""
+        timings = []
+        for i in range(self.lookups):
+            site = Site(pk=(i * 7919) % count + 10 if i % 2 else count + 10)
+            start = time.time()
+            EmailMessageTemplate.objects.get_template("Template 1", site)
+            timings.append(time.time() - start)
+        return sorted(timings)[len(timings) // 2]
+
+    def test_lookup_scaling(self):
+        content_type = ContentType.objects.get_for_model(Site)
+        results = []
+        created = 0
+        for size in self.sizes:
+            self.add_templates(content_type, created + 10, size + 10)
+            created = size
+            results.append((size, self.time_lookups(content_type, size)))
+
+        for size, median in results:
+            print("%7d templates: %.3fms per lookup" % (size, median * 1000))
+        self.assertTrue(results[-1][1] < results[0][1] * 3)
+
+
+JINJA2_TEMPLATES = settings.TEMPLATES + [{
+    'NAME': 'jinja2',
+    'BACKEND': 'django.template.backends.jinja2.Jinja2',
+    'DIRS': [],
+    'APP_DIRS': False,
+}]
+
+
+class TemplateEngineTest(TestCase):
+    """
+    Ensure that templates are compiled, rendered and validated with the 
+    configured template engine
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def test_context_settings(self):
+        """Ensure a Context's settings, such as autoescape, are kept"""
+        context = Context({'world': '<b>&'}, autoescape=False)
+        send_mail("Template 1", context=context,
+                  recipient_list=['to@example.com'])
+        self.assertEqual(mail.outbox[0].body, "Test 1 body <b>&")
+
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        message = template.render_message(context, ['to@example.com'])
+        self.assertEqual(message.body, "Test 1 body <b>&")
+        self.assertEqual(template.render_body({'world': '<b>&'}),
+                         "Test 1 body &lt;b&gt;&amp;")
+
+    def test_default_engine(self):
+        """Ensure the Django template engine is used by default"""
+        self.assertEqual(get_engine().__class__.__name__, 'DjangoTemplates')
+
+    def test_compiled_cache(self):
+        """Ensure each template string is only compiled once"""
+        clear_cache()
+        template = get_template("Hello {{ world }}")
+        self.assertTrue(get_template("Hello {{ world }}") is template)
+        clear_cache()
+        self.assertFalse(get_template("Hello {{ world }}") is template)
+
+    @skipUnless(jinja2, "Jinja2 isn't installed")
+    def test_jinja2_engine(self):
+        """Ensure messages can be rendered with another engine"""
+        with self.settings(TEMPLATES=JINJA2_TEMPLATES,
+                           EMAILMESSAGETEMPLATES_ENGINE='jinja2'):
+            template = EmailMessageTemplate.objects.get_template("Template 1")
+            template.body_template = "{{ hello ~ world }}"
+            message = template.render_message(self.context, ['to@example.com'])
+
+        self.assertEqual(message.subject, "Test 1 Subject *HELLO*")
+        self.assertEqual(message.body, "*HELLO**WORLD*")
+
+    @skipUnless(jinja2, "Jinja2 isn't installed")
+    def test_jinja2_validation(self):
+        """Ensure templates are validated with the configured engine"""
+        with self.settings(TEMPLATES=JINJA2_TEMPLATES,
+                           EMAILMESSAGETEMPLATES_ENGINE='jinja2'):
+            validate_template_syntax("{{ hello ~ world }}")
+            self.assertRaises(ValidationError, validate_template_syntax,
+                              "{% if world %} world")
+        self.assertRaises(ValidationError, validate_template_syntax,
+                          "{{ hello ~ world }}")
+
+
+@skipUnless(os.environ.get('EMAILMESSAGETEMPLATES_BENCHMARKS') and jinja2,
+            "Set EMAILMESSAGETEMPLATES_BENCHMARKS=1 and install Jinja2 to run "
+            "benchmarks")
+class TemplateEngineBenchmark(TestCase):
+    """
+    Compare the time taken to render the same stored templates with each 
+    template engine
+    """
+    fixtures = ['test_templates',]
+    renders = 5000
+
+    def time_renders(self, engine):
+        with self.settings(TEMPLATES=JINJA2_TEMPLATES,
+                           EMAILMESSAGETEMPLATES_ENGINE=engine):
+            template = EmailMessageTemplate.objects.get_template("Template 2")
+            template.body_template = (
+                "{% for item in items %}{{ item.name }}: {{ item.price }}\n"
+                "{% endfor %}Total: {{ total }}")
+            context = {'hello': 'Hello', 'total': 100,
+                       'items': [{'name': 'Item %s' % i, 'price': i}
+                                 for i in range(20)]}
+            start = time.time()
+            for i in range(self.renders):
+                message = template.render_message(context, ['to@example.com'])
+            return time.time() - start, message
+
+    def test_compare_engines(self):
+        results = [(engine,) + self.time_renders(engine)
+                   for engine in ('django', 'jinja2')]
+        for engine, duration, message in results:
+            print("%-7s %.1fus per message" % (
+                engine, duration / self.renders * 1000000))
+        self.assertEqual(results[0][2].body, results[1][2].body)
+
+
+FRAGMENT_TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'OPTIONS': {
+        'loaders': [
+            ('django.template.loaders.cached.Loader', [
+                'emailmessagetemplates.loaders.Loader',
+            ]),
+        ],
+    },
+}]
+
+
+class TemplateFragmentTest(TestCase):
+    """
+    Ensure that templates can include and extend fragments stored in the 
+    database, that fragments are cached, and that the cache is invalidated 
+    when fragments change
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+        EmailTemplateFragment.objects.create(
+            name="header", content="Header for {{ hello }}")
+        EmailTemplateFragment.objects.create(
+            name="layout", content="{% block content %}{% endblock %} -- Footer")
+
+    def render_body(self, body_template):
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.body_template = body_template
+        return template.render_message(self.context, ['to@example.com']).body
+
+    def test_include_fragment(self):
+        """Ensure fragments can be included"""
+        with self.settings(TEMPLATES=FRAGMENT_TEMPLATES):
+            self.assertEqual(self.render_body('{% include "header" %}: {{ world }}'),
+                             "Header for *HELLO*: *WORLD*")
+
+    def test_extend_fragment(self):
+        """Ensure fragments can be extended"""
+        with self.settings(TEMPLATES=FRAGMENT_TEMPLATES):
+            self.assertEqual(self.render_body('{% extends "layout" %}'
+                                              '{% block content %}{{ world }}'
+                                              '{% endblock %}'),
+                             "*WORLD* -- Footer")
+
+    def test_fragment_cached(self):
+        """Ensure fragments are only loaded from the database once"""
+        with self.settings(TEMPLATES=FRAGMENT_TEMPLATES):
+            template = EmailMessageTemplate.objects.get_template("Template 1")
+            template.body_template = '{% include "header" %}'
+            template.render_message(self.context, ['to@example.com'])
+            with self.assertNumQueries(0):
+                template.render_message(self.context, ['to@example.com'])
+
+    def test_fragment_invalidated(self):
+        """Ensure edited and deleted fragments aren't served from the cache"""
+        with self.settings(TEMPLATES=FRAGMENT_TEMPLATES):
+            self.render_body('{% include "header" %}')
+            header = EmailTemplateFragment.objects.get(name="header")
+            header.content = "New header"
+            header.save()
+            self.assertEqual(self.render_body('{% include "header" %}'),
+                             "New header")
+
+            header.delete()
+            self.assertEqual(self.render_body('{% include "header" %}'), "")
+
+    def test_fragment_changed_elsewhere(self):
+        """Ensure fragments changed by other processes are picked up"""
+        with self.settings(TEMPLATES=FRAGMENT_TEMPLATES,
+                           EMAILMESSAGETEMPLATES_FRAGMENT_CHECK_INTERVAL=0):
+            self.render_body('{% include "header" %}')
+            # As another process would, without signals reaching this one
+            EmailTemplateFragment.objects.filter(name="header").update(
+                content="New header")
+            self.assertEqual(self.render_body('{% include "header" %}'),
+                             "Header for *HELLO*")
+            caches['default'].set(FRAGMENTS_KEY, 'elsewhere')
+            self.assertEqual(self.render_body('{% include "header" %}'),
+                             "New header")
+
+    def test_other_templates_kept(self):
+        """
+        Ensure changing a fragment only discards cached fragments, and not 
+        the other templates the engine has cached
+        """
+        templates = [dict(FRAGMENT_TEMPLATES[0], OPTIONS={'loaders': [
+            ('django.template.loaders.cached.Loader', [
+                ('django.template.loaders.locmem.Loader',
+                 {'page.html': 'A page'}),
+                'emailmessagetemplates.loaders.Loader',
+            ]),
+        ]})]
+        with self.settings(TEMPLATES=templates):
+            django_engine = engines['django']
+            page = django_engine.get_template('page.html').template
+            self.render_body('{% include "header" %}')
+            self.assertEqual(self.render_body('{% include "footer" %}'), "")
+            EmailTemplateFragment.objects.filter(name="header").update(
+                content="New header")
+            EmailTemplateFragment.objects.create(name="footer",
+                                                 content="Footer")
+            self.assertTrue(django_engine.get_template('page.html').template
+                            is page)
+            self.assertEqual(self.render_body('{% include "header" %}'),
+                             "New header")
+            self.assertEqual(self.render_body('{% include "footer" %}'),
+                             "Footer")
+
+    def test_no_fragment_loader(self):
+        """
+        Ensure the shared cache isn't consulted when no engine loads fragments
+        """
+        with self.settings(EMAILMESSAGETEMPLATES_FRAGMENT_CHECK_INTERVAL=0):
+            with mock.patch('emailmessagetemplates.engine._fragment_cache') \
+                    as fragment_cache:
+                self.render_body('{{ hello }}')
+                self.render_body('{{ hello }}')
+            self.assertFalse(fragment_cache.called)
+
+
+class AdminQueryTest(TestCase):
+    """
+    Ensure the admin changelist loads templates and their related objects in a 
+    constant number of queries
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        sites = [Site.objects.create(domain='site%s.com' % i, name='Site %s' % i)
+                 for i in range(10)]
+        for site in sites:
+            EmailMessageTemplate.objects.create(
+                name="Per-site", related_object=site, subject_template="Hi",
+                description="")
+        self.admin = EmailMessageTemplateAdmin(EmailMessageTemplate, AdminSite())
+        self.request = RequestFactory().get('/')
+
+    def test_changelist_queries(self):
+        """
+        Ensure one query fetches the templates and one fetches the related 
+        objects of each content type, however many templates there are
+        """
+        # The content type of the related objects is looked up once (and then 
+        # cached for the life of the process)
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(3):
+            templates = list(self.admin.get_queryset(self.request))
+            labels = [unicode(template) for template in templates]
+            related = [template.related_item_display() for template in templates]
+
+        self.assertTrue("Per-site for site3.com" in labels)
+        self.assertTrue("site3.com" in related)
+        self.assertTrue("None" in related)
+
+    def changelist(self, **params):
+        """
+        Load the changelist as the admin would with the given filters and 
+        search, evaluating its filter choices and every column of its rows, 
+        and return the rows and the number of queries made
+        """
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        with CaptureQueriesContext(connection) as queries:
+            cl = self.admin.changelist_view(request).context_data['cl']
+            for spec in cl.filter_specs:
+                list(spec.choices(cl))
+            rows = [[lookup_field(name, result, self.admin)[2]
+                     for name in cl.list_display] for result in cl.result_list]
+        return rows, len(queries)
+
+    def test_changelist_view_queries(self):
+        """
+        Ensure the changelist makes the same number of queries with filters 
+        and a search however many templates there are
+        """
+        self.user = User.objects.create_superuser('admin', 'admin@example.com',
+                                                  'password')
+        content_type = ContentType.objects.get_for_model(Site)
+        params = {'enabled__exact': '1', 'q': 'per-site',
+                  'content_type__id__exact': str(content_type.pk)}
+        rows, queries = self.changelist(**params)
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(self.changelist()[1], queries)
+
+        for i in range(10, 30):
+            EmailMessageTemplate.objects.create(
+                name="Per-site", subject_template="Hi", description="",
+                related_object=Site.objects.create(domain='site%s.com' % i,
+                                                   name='Site %s' % i))
+        rows, more_queries = self.changelist(**params)
+        self.assertEqual(len(rows), 30)
+        # The columns are the action checkbox and then list_display
+        self.assertTrue('site23.com' in [row[2] for row in rows])
+        self.assertEqual(more_queries, queries)
+
+
+class LazyContextTest(TestCase):
+    """
+    Ensure the variables templates reference are found, and that lazy context 
+    values are only evaluated if they're rendered
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.calls = []
+
+    def lazy(self, name, value):
+        def compute():
+            self.calls.append(name)
+            return value
+        return Lazy(compute)
+
+    def test_referenced_variables(self):
+        """Ensure variables in tags, filters and conditions are found"""
+        source = ('{{ a.b|default:c }}{% if d and not e.f %}{% endif %}'
+                  '{% for x in g %}{{ x }}{{ forloop.counter }}{% endfor %}'
+                  '{% with y=h %}{{ y }}{% endwith %}{{ "literal" }}')
+        self.assertEqual(referenced_variables(source),
+                         frozenset(['a', 'c', 'd', 'e', 'g', 'h']))
+
+    def test_scoped_variables(self):
+        """
+        Ensure names bound by a tag are only left out inside that tag's block
+        """
+        self.assertEqual(
+            referenced_variables('{{ user.name }}{% for user in users %}'
+                                 '{{ user }}{% empty %}{{ user }}{% endfor %}'),
+            frozenset(['user', 'users']))
+        self.assertEqual(
+            referenced_variables('{% with total=order.total %}{{ total }}'
+                                 '{% endwith %} {{ total }}'),
+            frozenset(['order', 'total']))
+        self.assertEqual(
+            referenced_variables('{% for a in b %}{% if a %}{% with c=a %}'
+                                 '{{ c }}{{ d }}{% endwith %}{% endif %}'
+                                 '{% endfor %}{{ c }}'),
+            frozenset(['b', 'c', 'd']))
+
+    def test_included_variables(self):
+        """Ensure variables used by included and extended templates are found"""
+        EmailTemplateFragment.objects.create(name="header",
+                                             content="Header for {{ hello }}")
+        with self.settings(TEMPLATES=FRAGMENT_TEMPLATES):
+            self.assertEqual(
+                referenced_variables('{% include "header" %}{{ world }}'),
+                frozenset(['hello', 'world']))
+            self.assertEqual(
+                referenced_variables('{% include "header" with hello=world %}'
+                                     '{% for hello in g %}{% include "header" %}'
+                                     '{% endfor %}'),
+                frozenset(['world', 'g']))
+            self.assertEqual(
+                referenced_variables('{% include "header" with hello=world %}'
+                                     '{% include "header" %}'),
+                frozenset(['hello', 'world']))
+            self.assertEqual(referenced_variables('{% include name %}'), None)
+
+    def test_template_variables(self):
+        """Ensure a template reports the variables of its subject and body"""
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        self.assertEqual(template.referenced_variables(),
+                         frozenset(['hello', 'world']))
+
+    def test_lazy_values(self):
+        """
+        Ensure lazy values are only evaluated if they're used, and only once 
+        however many times they're used
+        """
+        template = EmailMessageTemplate.objects.get_template("Template 1")
+        template.body_template = "{{ world }} {% if world %}{{ world }}{% endif %}"
+        message = template.render_message(
+            {'hello': self.lazy('hello', '*HELLO*'),
+             'world': self.lazy('world', '*WORLD*'),
+             'unused': self.lazy('unused', '*UNUSED*')}, ['to@example.com'])
+
+        self.assertEqual(message.subject, "Test 1 Subject *HELLO*")
+        self.assertEqual(message.body, "*WORLD* *WORLD*")
+        self.assertEqual(sorted(self.calls), ['hello', 'world'])
+
+    @skipUnless(jinja2, "Jinja2 isn't installed")
+    def test_jinja2_lazy_values(self):
+        """Ensure only referenced lazy values are evaluated for other engines"""
+        with self.settings(TEMPLATES=JINJA2_TEMPLATES,
+                           EMAILMESSAGETEMPLATES_ENGINE='jinja2'):
+            self.assertEqual(
+                referenced_variables("{% for x in g %}{{ x ~ world }}{% endfor %}"),
+                frozenset(['g', 'world']))
+            template = EmailMessageTemplate.objects.get_template("Template 1")
+            message = template.render_message(
+                {'hello': self.lazy('hello', '*HELLO*'), 'world': '*WORLD*',
+                 'unused': self.lazy('unused', '*UNUSED*')}, ['to@example.com'])
+
+        self.assertEqual(message.subject, "Test 1 Subject *HELLO*")
+        self.assertEqual(self.calls, ['hello'])
+
+
+class SharedAttachmentTest(TestCase):
+    """
+    Ensure attachments are encoded once and shared by every message of a bulk 
+    send
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+        self.content = os.urandom(200000)
+        f = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+        f.write(self.content)
+        f.close()
+        self.path = f.name
+        self.addCleanup(os.remove, self.path)
+
+    def test_file_attachment(self):
+        """Ensure files are attached with their name, type and content"""
+        part = SharedAttachment(self.path).mime_part()
+
+        self.assertEqual(part.get_content_type(), 'application/pdf')
+        self.assertEqual(part.get_filename(), os.path.basename(self.path))
+        self.assertEqual(part.get_payload(decode=True), self.content)
+
+    def test_content_attachment(self):
+        """Ensure attachments can be given as content rather than a path"""
+        part = SharedAttachment(content=u'caf\xe9', filename='menu.txt').mime_part()
+
+        self.assertEqual(part.get_content_type(), 'text/plain')
+        self.assertEqual(part.get_payload(decode=True), 'caf\xc3\xa9')
+        self.assertRaises(ValueError, SharedAttachment)
+
+    def test_mass_mail_attachments(self):
+        """
+        Ensure every message of a bulk send shares the same encoded attachment
+        """
+        datatuple = [(self.context, 'from@example.com', ['to%s@example.com' % i])
+                     for i in range(3)]
+        send_mass_mail("Template 1", datatuple=datatuple,
+                       attachments=[self.path, ('notes.txt', 'Notes', 'text/plain')])
+
+        parts = [message.message().get_payload() for message in mail.outbox]
+        self.assertEqual(len(parts), 3)
+        self.assertTrue(parts[0][1] is parts[1][1] is parts[2][1])
+        self.assertEqual(parts[0][1].get_payload(decode=True), self.content)
+        self.assertEqual(parts[2][2].get_payload(decode=True), 'Notes')
+        self.assertTrue(mail.outbox[0].attachments[0] is
+                        mail.outbox[2].attachments[0])
+        for message in mail.outbox:
+            self.assertTrue('Content-Transfer-Encoding: base64' in
+                            message.message().as_string())
+
+    def test_send_mail_attachments(self):
+        """Ensure single messages can use the same attachments"""
+        send_mail("Template 1", context=self.context,
+                  recipient_list=['to@example.com'], attachments=[self.path])
+
+        attachment = mail.outbox[0].message().get_payload()[1]
+        self.assertEqual(attachment.get_payload(decode=True), self.content)
+
+
+class ProfileRenderCommandTest(TestCase):
+    """
+    Ensure the profile_render command renders every context without sending 
+    anything, and reports the time taken
+    """
+    fixtures = ['test_templates',]
+
+    def write_contexts(self, suffix, content):
+        f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+        f.write(content)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def profile_render(self, *args, **options):
+        stdout = StringIO()
+        call_command('profile_render', *args, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_jsonl_contexts(self):
+        """Ensure each phase is reported for every rendered context"""
+        path = self.write_contexts('.jsonl', '\n'.join(
+            '{"hello": "Hello %d", "world": "World"}' % i for i in range(20)) +
+            '\n[]\n')
+
+        self.assertRaises(CommandError, self.profile_render, "Template 1", path)
+        with open(path, 'w') as f:
+            f.write('{"hello": "Hello", "world": "World"}\n\n{"hello": "Hi"}\n')
+        output = self.profile_render("Template 1", path, slowest=1)
+
+        self.assertTrue("Rendered 2 messages (0 failed)" in output)
+        for phase in ('subject', 'html', 'text', 'mime', 'total'):
+            self.assertTrue("\n%s " % phase in output)
+        self.assertEqual(output.count("  Line "), 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_csv_contexts(self):
+        """Ensure contexts can be read from CSV files"""
+        path = self.write_contexts('.csv', 'hello,world\nHello,World\nHi,There\n')
+        output = self.profile_render("Template 1", path,
+                                     related_object='sites.site:1')
+
+        self.assertTrue("Rendered 2 messages (0 failed)" in output)
+        self.assertTrue('"world": "There"' in output)
+
+    def test_profile(self):
+        """Ensure cProfile stats are written when requested"""
+        path = self.write_contexts('.jsonl', '{"hello": "Hello"}\n')
+        stats = self.write_contexts('.prof', '')
+        output = self.profile_render("Template 1", path, profile=stats)
+
+        self.assertTrue("Profile written to %s" % stats in output)
+        self.assertTrue(os.path.getsize(stats))
+
+    def test_missing_template(self):
+        """Ensure unknown templates and related objects are reported"""
+        path = self.write_contexts('.jsonl', '{}\n')
+        self.assertRaises(CommandError, self.profile_render, "Missing", path)
+        self.assertRaises(CommandError, self.profile_render, "Template 1", path,
+                          related_object='sites.site:99')
+
+
+class TemplateImportTest(TestCase):
+    """
+    Ensure templates can be exported and imported in bulk
+    """
+    fixtures = ['test_templates',]
+
+    def rows(self, count, subject="Subject {{ hello }}"):
+        return [{'name': "Bulk %d" % i, 'content_type': ['sites', 'site'],
+                 'object_id': 1, 'subject_template': subject,
+                 'body_template': "Body %d {{ world }}" % i, 'description': ''}
+                for i in range(count)]
+
+    def test_round_trip(self):
+        """Ensure exported templates import unchanged"""
+        rows = EmailMessageTemplate.objects.export_templates()
+        self.assertEqual(len(rows), EmailMessageTemplate.objects.count())
+        self.assertEqual(EmailMessageTemplate.objects.import_templates(rows),
+                         {'created': 0, 'updated': 0, 'unchanged': len(rows)})
+
+    def test_import(self):
+        """
+        Ensure templates are created and updated in a constant number of 
+        queries, and can be retrieved by name and related object
+        """
+        EmailMessageTemplate.objects.import_templates(self.rows(10))
+        rows = self.rows(20, subject="New subject {{ hello }}")
+        # A savepoint, and queries to find existing templates, create templates, 
+        # find their IDs, update templates and create their new versions
+        with self.assertNumQueries(7):
+            counts = EmailMessageTemplate.objects.import_templates(rows)
+
+        self.assertEqual(counts, {'created': 10, 'updated': 10, 'unchanged': 0})
+        template = EmailMessageTemplate.objects.get_template(
+            "Bulk 3", Site.objects.get(pk=1))
+        self.assertEqual(template.subject_template, "New subject {{ hello }}")
+        self.assertEqual(template.body_template, "Body 3 {{ world }}")
+        self.assertEqual(template.description, '')
+        self.assertTrue(template.edited_date)
+        self.assertEqual(template.version, 2)
+        self.assertEqual(template.get_version(1).subject_template,
+                         "Subject {{ hello }}")
+
+    def test_import_validation(self):
+        """Ensure nothing is imported if any templates are invalid"""
+        rows = self.rows(3) + [{'name': "Broken", 'type': 'text/rtf',
+                                'subject_template': "{% if %}"}]
+        with self.assertRaises(ValidationError) as cm:
+            EmailMessageTemplate.objects.import_templates(rows)
+
+        self.assertEqual(len(cm.exception.messages), 2)
+        self.assertTrue("subject_template" in cm.exception.messages[1])
+        self.assertFalse(EmailMessageTemplate.objects.filter(
+            name__startswith="Bulk").exists())
+
+    def test_import_command(self):
+        """Ensure fixtures and exported files can be imported"""
+        path = os.path.join(os.path.dirname(__file__), 'fixtures',
+                            'test_templates.json')
+        stdout = StringIO()
+        call_command('import_templates', path, stdout=stdout)
+        self.assertTrue("Created 0, updated 0 and left 8 unchanged" in
+                        stdout.getvalue())
+
+        stdout = StringIO()
+        call_command('export_templates', format='yaml' if yaml else 'json',
+                     stdout=stdout)
+        EmailMessageTemplate.objects.all().delete()
+        exported = self.write_file('.yaml' if yaml else '.json',
+                                   stdout.getvalue())
+        stdout = StringIO()
+        call_command('import_templates', exported, stdout=stdout)
+        self.assertTrue("Created 8, updated 0" in stdout.getvalue())
+        self.assertEqual(EmailMessageTemplate.objects.get_template(
+            "Template 2").base_cc, ['a@example.com', 'b@example.com'])
+
+    def write_file(self, suffix, content):
+        f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+        f.write(content.encode('utf-8'))
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+
+@skipUnless(os.environ.get('EMAILMESSAGETEMPLATES_BENCHMARKS'),
+            "Set EMAILMESSAGETEMPLATES_BENCHMARKS=1 to run benchmarks")
+class TemplateImportBenchmark(TestCase):
+    """
+    Compare importing templates in bulk with saving them one at a time
+    """
+    count = 50000
+
+    def rows(self, count, subject):
+        return [{'name': "Bulk", 'content_type': ['sites', 'site'],
+                 'object_id': i, 'subject_template': subject,
+                 'body_template': "Body {{ world }}", 'description': ''}
+                for i in range(count)]
+
+    def test_import_speed(self):
+        content_type = ContentType.objects.get_for_model(Site)
+        start = time.time()
+        for row in self.rows(self.count // 50, "Subject {{ hello }}"):
+            template = EmailMessageTemplate(**dict(row, content_type=content_type))
+            template.clean_fields(exclude=['description'])
+            template.save()
+        saving = (time.time() - start) * 50
+        EmailMessageTemplate.objects.all().delete()
+
+        start = time.time()
+        EmailMessageTemplate.objects.import_templates(
+            self.rows(self.count, "Subject {{ hello }}"))
+        creating = time.time() - start
+        start = time.time()
+        EmailMessageTemplate.objects.import_templates(
+            self.rows(self.count, "New subject {{ hello }}"))
+        updating = time.time() - start
+
+        print("%d templates: %.1fs saved individually (estimated), %.1fs "
+              "created and %.1fs updated in bulk" %
+              (self.count, saving, creating, updating))
+        self.assertTrue(creating < saving and updating < saving)
+
+
+class TemplateVersionTest(TestCase):
+    """
+    Ensure each saved version of a template is kept, and that messages can be 
+    rendered from a particular version
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+        self.template = EmailMessageTemplate.objects.get_template("Template 1")
+        self.template.subject_template = "Version 2 {{ hello }}"
+        self.template.save()
+
+    def test_versions(self):
+        """Ensure saving a template adds a version with its content"""
+        self.assertEqual(self.template.version, 2)
+        self.assertEqual(self.template.cache_key, (self.template.pk, 2))
+        self.assertEqual([(v.version, v.subject_template)
+                          for v in self.template.versions.all()],
+                         [(2, "Version 2 {{ hello }}"),
+                          (1, "Test 1 Subject {{hello}}")])
+
+    def test_get_version(self):
+        """Ensure templates can be rendered as they were at a version"""
+        pinned = EmailMessageTemplate.objects.get_template("Template 1",
+                                                           version=1)
+        self.assertEqual(pinned.pk, self.template.pk)
+        self.assertEqual(pinned.cache_key, (self.template.pk, 1))
+        self.assertEqual(pinned.render_subject(self.context),
+                         "Test 1 Subject *HELLO*")
+        self.assertTrue(self.template.get_version(2) is self.template)
+        self.assertRaises(EmailMessageTemplateVersion.DoesNotExist,
+                          self.template.get_version, 5)
+
+    def test_restore_version(self):
+        """Ensure saving an earlier version restores it as a new version"""
+        self.template.get_version(1).save()
+        template = EmailMessageTemplate.objects.get(pk=self.template.pk)
+
+        self.assertEqual(template.version, 3)
+        self.assertEqual(template.subject_template, "Test 1 Subject {{hello}}")
+
+    def test_stale_instance(self):
+        """Ensure a stale instance is saved as the next version of its row"""
+        stale = EmailMessageTemplate.objects.get(pk=self.template.pk)
+        self.template.save()
+        stale.save()
+
+        self.assertEqual((self.template.version, stale.version), (3, 4))
+        self.assertEqual([v.version for v in stale.versions.all()],
+                         [4, 3, 2, 1])
+
+    def test_atomic_save(self):
+        """Ensure a template isn't saved unless its version is"""
+        self.template.subject_template = "Version 3"
+        with mock.patch.object(EmailMessageTemplateVersion, 'save',
+                               side_effect=ValueError):
+            self.assertRaises(ValueError, self.template.save)
+        template = EmailMessageTemplate.objects.get(pk=self.template.pk)
+
+        self.assertEqual((template.version, template.subject_template),
+                         (2, "Version 2 {{ hello }}"))
+
+    def test_send_version(self):
+        """Ensure sends can be pinned to a version"""
+        send_mail("Template 1", context=self.context, version=1,
+                  recipient_list=['to@example.com'])
+        send_mass_mail("Template 1", version=1, datatuple=[
+            (self.context, 'from@example.com', ['to@example.com'])])
+
+        self.assertEqual([message.subject for message in mail.outbox],
+                         ["Test 1 Subject *HELLO*"] * 2)
+
+
+class RenderStatsTest(TestCase):
+    """
+    Ensure render statistics are collected in memory, written in batches and 
+    shown in the admin, and that slow renders are logged
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+        render_stats.flush()
+
+    def render(self, count, name="Template 5"):
+        template = EmailMessageTemplate.objects.get_template(name)
+        for i in range(count):
+            template.render_message(self.context, ['to@example.com'])
+        return template
+
+    def test_batched_stats(self):
+        """Ensure statistics are only written when they're flushed"""
+        with self.settings(EMAILMESSAGETEMPLATES_STATS=True,
+                           EMAILMESSAGETEMPLATES_ALLOW_HTML_MESSAGES=True):
+            with self.assertNumQueries(1):
+                template = self.render(5)
+            self.assertFalse(EmailMessageTemplateStats.objects.exists())
+            render_stats.flush()
+            self.render(3)
+            render_stats.flush()
+
+        stats = EmailMessageTemplateStats.objects.get(template=template)
+        self.assertEqual(stats.render_count, 8)
+        self.assertEqual(stats.slow_count, 0)
+        self.assertTrue(stats.average_size > 0)
+        for part in ('subject', 'html', 'text'):
+            self.assertTrue(0 < getattr(stats, part + '_p50') <=
+                            getattr(stats, part + '_p95'))
+
+        admin = EmailMessageTemplateAdmin(EmailMessageTemplate, AdminSite())
+        self.assertTrue("8 messages rendered" in admin.render_statistics(template))
+        self.assertEqual(admin.render_statistics(EmailMessageTemplate()),
+                         "None recorded")
+
+    def test_flush_interval(self):
+        """
+        Ensure statistics are written periodically by a background thread 
+        rather than by the thread rendering messages
+        """
+        flushed = threading.Event()
+        threads = []
+
+        def flush():
+            threads.append(threading.current_thread())
+            flushed.set()
+        with mock.patch.object(render_stats, 'flush', flush):
+            with self.settings(EMAILMESSAGETEMPLATES_STATS=True,
+                               EMAILMESSAGETEMPLATES_STATS_FLUSH_INTERVAL=0):
+                with self.assertNumQueries(1):
+                    self.render(2, "Template 1")
+                self.assertTrue(flushed.wait(5))
+
+        self.assertTrue(threads[0] is render_stats.thread)
+        self.assertFalse(threads[0] is threading.current_thread())
+        pk = EmailMessageTemplate.objects.get_template("Template 1").pk
+        self.assertEqual(render_stats.pending[pk].count, 2)
+
+    def test_stats_disabled(self):
+        """Ensure nothing is recorded unless statistics are enabled"""
+        self.render(2, "Template 1")
+        render_stats.flush()
+        self.assertFalse(EmailMessageTemplateStats.objects.exists())
+
+    def test_slow_render(self):
+        """Ensure renders over the threshold are logged with the context keys"""
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        stats_logger.addHandler(handler)
+        self.addCleanup(stats_logger.removeHandler, handler)
+        with self.settings(EMAILMESSAGETEMPLATES_SLOW_RENDER_THRESHOLD=0):
+            self.render(1, "Template 1")
+
+        self.assertEqual(len(records), 2)
+        self.assertTrue("Template 1" in records[0].getMessage())
+        self.assertTrue("context keys: hello, world" in records[0].getMessage())
+
+
+# Imports emailmessagetemplates.utils in a new interpreter (with settings 
+# configured but the app registry not yet loaded, as in a worker or script at 
+# startup) and prints the time taken and the heavy modules it loaded
+IMPORT_SCRIPT = """
+import sys, json
+from timeit import default_timer
+from django.conf import settings
+settings.configure(INSTALLED_APPS=['django.contrib.contenttypes',
+                                   'emailmessagetemplates'])
+start = default_timer()
+import emailmessagetemplates.utils
+elapsed = default_timer() - start
+heavy = ('emailmessagetemplates.models', 'emailmessagetemplates.conf', 
+         'emailmessagetemplates.delivery', 'appconf', 'django.forms', 
+         'html2text')
+print(json.dumps({'seconds': elapsed, 
+                  'loaded': [m for m in heavy if sys.modules.get(m)]}))
+"""
+
+
+def import_utils():
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SCRIPT],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+class ImportTest(TestCase):
+    """
+    Ensure the package is cheap to import, and optional dependencies are only 
+    looked for once
+    """
+
+    def test_deferred_imports(self):
+        """Ensure importing utils doesn't load the models or their dependencies"""
+        self.assertEqual(import_utils()['loaded'], [])
+
+    def test_html2text_cached(self):
+        """Ensure a missing html2text is only looked for once"""
+        self.addCleanup(setattr, models, '_html2text_function',
+                        models._html2text_function)
+        models._html2text_function = models._unset
+        real_import = __builtins__['__import__'] \
+            if isinstance(__builtins__, dict) else __builtins__.__import__
+        attempts = []
+
+        def fake_import(name, *args, **kwargs):
+            if name == 'html2text':
+                attempts.append(name)
+                raise ImportError(name)
+            return real_import(name, *args, **kwargs)
+
+        template = EmailMessageTemplate.objects.create(
+            name="HTML", type='text/html', subject_template="Subject",
+            body_template="Text {{ hello }}",
+            body_template_html="<p>HTML {{ hello }}</p>")
+        with mock.patch('__builtin__.__import__', fake_import):
+            with self.settings(EMAILMESSAGETEMPLATES_ALLOW_HTML_MESSAGES=True):
+                for i in range(3):
+                    self.assertEqual(template.render_body({'hello': 1}),
+                                     "Text 1")
+        self.assertEqual(attempts, ['html2text'])
+
+
+@skipUnless(os.environ.get('EMAILMESSAGETEMPLATES_BENCHMARKS'),
+            "Set EMAILMESSAGETEMPLATES_BENCHMARKS=1 to run benchmarks")
+class ImportBenchmark(TestCase):
+    """
+    Measure the time taken to import utils in a new interpreter
+    """
+    runs = 10
+
+    def test_import_time(self):
+        times = sorted(import_utils()['seconds'] for i in range(self.runs))
+        print("Importing emailmessagetemplates.utils: %.1fms (median of %d)" %
+              (times[self.runs // 2] * 1000, self.runs))
+        self.assertTrue(times[self.runs // 2] < 0.5)
+
+
+class RenderMassMailTest(TestCase):
+    """
+    Ensure messages can be rendered for sending by other means, one at a time
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+
+    def datatuple(self, read):
+        for i in itertools.count():
+            read.append(i)
+            yield (dict(self.context, hello=i), None, ['to%d@example.com' % i])
+
+    def test_rendered_on_demand(self):
+        """Ensure rows are only read and rendered as messages are requested"""
+        read = []
+        messages = render_mass_mail("Template 1", datatuple=self.datatuple(read))
+        self.assertEqual(read, [])
+
+        first = next(messages)
+        self.assertTrue(isinstance(first, RenderedMessage))
+        self.assertEqual(first.subject, "Test 1 Subject 0")
+        self.assertEqual(first.to, ['to0@example.com'])
+        self.assertEqual(first.from_email, settings.DEFAULT_FROM_EMAIL)
+        self.assertEqual([m.to for m in itertools.islice(messages, 2)],
+                         [['to1@example.com'], ['to2@example.com']])
+        self.assertEqual(read, [0, 1, 2])
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_as_bytes(self):
+        """Ensure complete MIME messages can be rendered"""
+        messages = render_mass_mail(
+            "Template 1", Site.objects.get(pk=1), as_bytes=True,
+            datatuple=[(self.context, 'from@example.com', ['to@example.com'])],
+            attachments=[('notes.txt', 'Notes', 'text/plain')])
+        message, = list(messages)
+        self.assertTrue(isinstance(message, bytes))
+        self.assertTrue(b'Subject: Test 1 (with related object) Subject *HELLO*' in message)
+        self.assertTrue(b'To: to@example.com' in message)
+        self.assertTrue(b'filename="notes.txt"' in message)
+
+    def test_missing_template(self):
+        """Ensure a missing template is reported before iterating"""
+        self.assertRaises(EmailMessageTemplate.DoesNotExist, render_mass_mail,
+                          "Missing", datatuple=[])
+
+
+class LoadTestTest(TestCase):
+    """
+    Ensure the send helpers can be driven against a local SMTP sink, and that 
+    the sink's throttling and failures are handled
+    """
+    fixtures = ['test_templates',]
+
+    def setUp(self):
+        self.context = {'hello': '*HELLO*', 'world': '*WORLD*'}
+        self.scheduler_options = {'chunk_size': 5, 'retries': 5,
+                                  'backoff': 0.2, 'max_backoff': 1.0}
+
+    def send(self, sink, **kwargs):
+        with sink:
+            return loadtest.run_load_test(
+                sink, "Template 1", context=self.context,
+                scheduler_options=self.scheduler_options, **kwargs)
+
+    def test_throughput(self):
+        """Ensure every message reaches the sink, over the expected connections"""
+        results = self.send(SMTPSink(latency=0.01), count=40,
+                            send_mail_count=5, concurrency=(1, 4))
+
+        self.assertEqual([(r.helper, r.concurrency, r.sent, r.failed)
+                          for r in results],
+                         [('send_mail', 1, 5, 0), ('send_mass_mail', 1, 40, 0),
+                          ('send_mass_mail', 4, 40, 0)])
+        self.assertEqual([(r.stats['messages'], r.stats['connections'])
+                          for r in results], [(5, 5), (40, 1), (40, 4)])
+        self.assertTrue(results[-1].stats['peak_connections'] > 1)
+        self.assertTrue(results[-1].rate > 0)
+
+    def test_throttling(self):
+        """Ensure messages refused with a 421 reply are retried"""
+        results = self.send(SMTPSink(max_rate=10), count=15,
+                            send_mail_count=0, concurrency=(2,))
+
+        self.assertEqual((results[-1].sent, results[-1].failed), (15, 0))
+        self.assertTrue(results[-1].stats['throttled'] > 0)
+        self.assertEqual(results[-1].stats['messages'], 15)
+
+    def test_failures(self):
+        """Ensure refused messages are reported as errors"""
+        self.scheduler_options['retries'] = 1
+        self.scheduler_options['backoff'] = 0.01
+        results = self.send(SMTPSink(failure_rate=1.0, failure_code=451),
+                            count=4, send_mail_count=2, concurrency=(2,))
+
+        self.assertEqual([(r.sent, r.failed, r.errors) for r in results],
+                         [(0, 2, {'SMTPDataError': 2}),
+                          (0, 4, {'SMTPDataError': 4})])
+        # Temporary failures are retried once by send_mass_mail
+        self.assertEqual([r.stats['failed'] for r in results], [2, 8])
+
+    def test_connection_limit(self):
+        """Ensure connections over the sink's limit don't stop the send"""
+        # The refused worker gives up long before the send finishes
+        self.scheduler_options.update(retries=1, backoff=0.01)
+        results = self.send(SMTPSink(latency=0.005, max_connections=1),
+                            count=100, send_mail_count=0, concurrency=(2,))
+
+        self.assertEqual((results[-1].sent, results[-1].failed), (100, 0))
+        self.assertEqual(results[-1].stats['peak_connections'], 1)
+        self.assertTrue(results[-1].stats['refused_connections'] > 0)
+
+    def test_command(self):
+        """Ensure the load_test_smtp command reports each run"""
+        out = StringIO()
+        call_command('load_test_smtp', "Template 1", count=10,
+                     send_mail_count=2, concurrency='1,2', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith("send_mail "))
+        self.assertEqual(lines[3].split()[:4], ["send_mass_mail", "2", "10", "0"])
@@ -1,14 +1,19 @@
-import copy
+from functools import partial
 
 from django.core.mail import get_connection
 from django.conf import settings
+from django.utils import six
 
-from models import EmailMessageTemplate
+from attachments import shared_attachments, mime_part
+
+# The models and delivery modules are imported when they're first needed, so
+# this module can be imported cheaply (and before the app registry is ready)
 
 
 def send_mail(name, related_object=None, context={}, from_email=None,
               recipient_list=[], fail_silently=False, auth_user=None,
-               auth_password=None, connection=None):
+               auth_password=None, connection=None, attachments=None,
+               version=None):
     """
     Easy wrapper for sending a single templated message to a recipient list.  
     The template to use is retrieved from the database based on the name and 
@@ -19,9 +24,17 @@ def send_mail(name, related_object=None, context={}, from_email=None,
 
     If auth_user is None, the EMAIL_HOST_USER setting is used.
     If auth_password is None, the EMAIL_HOST_PASSWORD setting is used.
+
+    Attachments can be given as file paths, (filename, content, mimetype) 
+    tuples, SharedAttachments or MIME parts.
+
+    If a version number is given, the template is sent as it was at that 
+    version.
     """
+    from models import EmailMessageTemplate
 
-    template = EmailMessageTemplate.objects.get_template(name, related_object)
+    template = EmailMessageTemplate.objects.get_template(name, related_object,
+                                                         version)
 
     connection = connection or get_connection(username=auth_user,
                                               password=auth_password,
@@ -31,12 +44,16 @@ def send_mail(name, related_object=None, context={}, from_email=None,
     template.from_email=from_email
     template.to=recipient_list
     template.connection=connection
+    for attachment in shared_attachments(attachments):
+        template.attach(mime_part(attachment))
 
     return template.send()
 
 
 def send_mass_mail(name, related_object=None, datatuple=(), fail_silently=False,
-                   auth_user=None, auth_password=None, connection=None):
+                   auth_user=None, auth_password=None, connection=None,
+                   scheduler=None, return_result=False, connections=None,
+                   attachments=None, version=None):
     """
     Given a datatuple of (context, from_email, recipient_list), renders and 
     sends a message to each recipient list. Returns the number of emails sent.
@@ -51,24 +68,100 @@ def send_mass_mail(name, related_object=None, datatuple=(), fail_silently=False,
     retrieve a template with the specified name without a related object instead
     (to support situations where some objects have a specialized template, but, 
     when none exists, we want to fall back to a default). 
+
+    Messages are sent through a DeliveryScheduler, which applies the rate 
+    limit, connection cap and retry behavior configured by the 
+    EMAILMESSAGETEMPLATES_SEND_* settings.  A scheduler configured differently 
+    can be passed instead.  If a connection is passed, all messages are sent 
+    through it; otherwise up to the scheduler's concurrency connections are 
+    opened.
+
+    To spread the messages across several relays, pass a list of connections 
+    and/or dictionaries of get_connection arguments (optionally including a 
+    'weight', 'concurrency' and 'rate' for the relay) as connections.  Relays 
+    are sent to concurrently, and messages fail over to the other relays if 
+    one can't be reached.
+
+    A message that fails doesn't stop the rest from being sent.  If 
+    return_result is True, a BulkResult reporting the status, error and timing 
+    of each row is returned instead of the number sent, and errors are never 
+    raised; its failed_rows method gives the rows to retry.  Otherwise the 
+    first error is raised once all rows have been attempted, unless 
+    fail_silently is True.
+
+    Attachments (given as for send_mail) are added to every message.  Each is 
+    read and encoded once, and the encoded content shared by all the messages.
+
+    The template is read once, so every message is rendered from the same 
+    content even if the template is edited during the send.  To send a 
+    particular version of the template (e.g. the same version from several 
+    processes), pass its version number.
+    """
+    from models import EmailMessageTemplate
+    from delivery import DeliveryScheduler
+
+    template = EmailMessageTemplate.objects.get_template(name, related_object,
+                                                         version)
+
+    scheduler = scheduler or DeliveryScheduler()
+    if connection:
+        connection_factory = lambda: connection
+    else:
+        # Errors are reported through the result rather than being swallowed
+        # by the connection
+        connection_factory = lambda: get_connection(username=auth_user,
+                                                    password=auth_password)
+
+    attachments = shared_attachments(attachments)
+
+    # Each message is rendered as it's sent
+    messages = [partial(template.render_message, context, recipient_list,
+                        from_email, attachments=attachments)
+                for (context, from_email, recipient_list) in datatuple]
+
+    result = scheduler.deliver(messages, connection_factory,
+                               concurrency=1 if connection else None,
+                               relays=connections)
+    if return_result:
+        return result
+    if not fail_silently:
+        for row in result.failures:
+            if row.exc_info is not None:
+                # Keep the traceback of where the message failed
+                six.reraise(*row.exc_info)
+            if row.error is not None:
+                raise row.error
+    return result.sent
+
+
+def render_mass_mail(name, related_object=None, datatuple=(),
+                     attachments=None, version=None, as_bytes=False):
     """
+    Given a datatuple of (context, from_email, recipient_list), returns an 
+    iterator of the messages send_mass_mail would send, for delivery by other 
+    means (e.g. a queue or a spool directory).  The template is looked up as 
+    for send_mass_mail.
+
+    Each message is rendered as it's requested, and the datatuple is read one 
+    row at a time, so it can be a generator of any length; only the message 
+    being rendered is held in memory.  Messages are RenderedMessages, which can 
+    be passed to any email backend, or bytes of the complete MIME message if 
+    as_bytes is True.  An error rendering a message is raised from the 
+    iterator.
+    """
+    from models import EmailMessageTemplate
 
-    template = EmailMessageTemplate.objects.get_template(name, related_object)
+    template = EmailMessageTemplate.objects.get_template(name, related_object,
+                                                         version)
+    return _render_messages(template, datatuple,
+                            shared_attachments(attachments), as_bytes)
 
-    connection = connection or get_connection(username=auth_user,
-                                              password=auth_password,
-                                              fail_silently=fail_silently)
 
-    messages = []
+def _render_messages(template, datatuple, attachments, as_bytes):
     for (context, from_email, recipient_list) in datatuple:
-        message = copy.deepcopy(template)
-        message.context=context
-        message.from_email=from_email
-        message.to=recipient_list
-        message.connection=connection
-        messages.append(message)
-
-    return connection.send_messages(messages)
+        message = template.render_message(context, recipient_list, from_email,
+                                          attachments=attachments)
+        yield message.as_bytes() if as_bytes else message
 
 
 def mail_admins(name, related_object=None, context={}, fail_silently=False,